@@ -0,0 +1,126 @@
+"""
+Compares live-row queries on a Delible model (via DelibleManager) with no
+index, a plain index and a DelibleIndex on the filtered column, on SQLite.
+
+    python benchmarks/delible_index.py [--rows 200000] [--deleted 0.1 0.7]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+DATABASE = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'generic',
+    ],
+    DATABASES={'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE,
+    }},
+)
+django.setup()
+
+from django.core.management import call_command
+from django.db import connection, models
+
+from generic.models.delible import Delible, DelibleIndex, DelibleManager
+
+CATEGORIES = 100
+
+
+class Item(Delible):
+    category = models.IntegerField()
+    title = models.CharField(max_length=50)
+
+    objects = DelibleManager()
+
+    class Meta:
+        app_label = 'generic'
+
+
+INDEXES = (
+    ('no index', None),
+    ('plain index', models.Index(fields=['category'], name='item_cat_idx')),
+    ('DelibleIndex', DelibleIndex(fields=['category'], name='item_cat_liv')),
+)
+
+QUERIES = (
+    ('count', lambda category: Item.objects.filter(
+        category=category).count()),
+    ('latest 20', lambda category: list(Item.objects.filter(
+        category=category).order_by('-pk')[:20])),
+)
+
+
+def populate(rows, deleted_fraction):
+    Item.objects.all_with_deleted().hard_delete()
+    random.seed(0)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO %s (category, title, deleted) VALUES (%%s, %%s, %%s)'
+            % Item._meta.db_table,
+            [
+                (
+                    random.randrange(CATEGORIES),
+                    'item %d' % i,
+                    '2020-01-01 00:00:00'
+                    if random.random() < deleted_fraction else None,
+                )
+                for i in range(rows)
+            ]
+        )
+
+
+def run(rows, deleted_fraction, repeat):
+    populate(rows, deleted_fraction)
+    print('\n%d rows, %d%% deleted (ms per query, best of %d)' % (
+        rows, deleted_fraction * 100, repeat))
+    print('%-14s' % '' + ''.join('%12s' % name for name, query in QUERIES))
+    for label, index in INDEXES:
+        with connection.schema_editor() as schema_editor:
+            if index is not None:
+                schema_editor.add_index(Item, index)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        timings = []
+        for name, query in QUERIES:
+            categories = iter(range(10 ** 6))
+            timings.append(min(timeit.repeat(
+                lambda: query(next(categories) % CATEGORIES),
+                number=CATEGORIES, repeat=repeat,
+            )) / CATEGORIES * 1000)
+        print('%-14s' % label + ''.join('%12.3f' % t for t in timings))
+        with connection.schema_editor() as schema_editor:
+            if index is not None:
+                schema_editor.remove_index(Item, index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument(
+        '--deleted', type=float, nargs='+', default=[0.1, 0.7])
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+    call_command('migrate', verbosity=0) # for deleted_by's users table
+    with connection.schema_editor() as schema_editor:
+        schema_editor.create_model(Item)
+    try:
+        for deleted_fraction in options.deleted:
+            run(options.rows, deleted_fraction, options.repeat)
+    finally:
+        os.remove(DATABASE)
+
+
+if __name__ == '__main__':
+    main()
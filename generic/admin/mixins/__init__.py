@@ -6,6 +6,7 @@ from .cooking import (
 )
 from .csv import CSVExportAdmin
 from .delible import DelibleAdmin
+from .inheritable import InheritableAdmin
 from .owrt import OWRTInline, OWRTStackedInline
 from .related import ChangeFormOnlyAdmin, ChangeLinkInline
 from .return_url import ReturnURLAdminMixin
@@ -15,6 +15,8 @@ from ..widgets import (
     TabularInlineManyToManyCookedIdWidget,
     StackedInlineForeignKeyCookedIdWidget,
     StackedInlineManyToManyCookedIdWidget,
+    get_cooked_version,
+    watch_cooked_model,
 )
 
 from django.conf.urls import url
@@ -35,8 +37,18 @@ class BaseCookedIdAdmin:
     Simply list fields in self.cooked_id_widgets instead of self.raw_id_widgets
 
     Override self.cook() to customise cooked object representations.
+
+    Large selections are cooked via POST (see cook_ids_post) in chunks of
+    self.cooked_id_chunk_size ids.
+
+    Cooked data is cached client-side per field (cook URL) and pk; responses
+    carry an X-Cooked-Version stamp which changes whenever an object of the
+    cooked model is saved or deleted. Stamps live in the default cache, so
+    changes made by other processes only invalidate cooked data if they
+    share it (e.g. memcached, not the per-process locmem default).
     """
     cooked_id_fields = ()
+    cooked_id_chunk_size = 500
 
     def cook(self, obj, request, field_name):
         """
@@ -60,36 +72,86 @@ class BaseCookedIdAdmin:
         # TODO: extend to support non-integer/non-`id` PKs
         if not field_name in self.cooked_id_fields:
             raise http.Http404
+        ids = self._parse_cooked_ids(raw_ids)
+        response_data = {}
+        for chunk in self._iter_cooked_chunks(request, field_name, ids):
+            response_data.update(chunk)
+
+        content_type_kwarg = (
+            'content_type' if django.VERSION >= (1,7) else 'mimetype'
+        )
+        response = http.HttpResponse(
+            json.dumps(response_data),
+            **{content_type_kwarg: 'application/json'}
+        )
+        return self._stamp_cooked_version(response, field_name)
+
+    def cook_ids_post(self, request, field_name):
+        """
+        POST variant of cook_ids() for selections too large for a URL.
+
+        Expects a comma-separated `ids` parameter in the request body, and
+        streams newline-delimited JSON: one object of cooked data per chunk
+        of `cooked_id_chunk_size` ids, so the widget can render progressively.
+        """
+        if request.method != 'POST':
+            return http.HttpResponseNotAllowed(['POST'])
+        if not field_name in self.cooked_id_fields:
+            raise http.Http404
+        ids = self._parse_cooked_ids(request.POST.get('ids', ''))
+        response = http.StreamingHttpResponse(
+            (
+                json.dumps(chunk) + '\n' for chunk in
+                self._iter_cooked_chunks(request, field_name, ids)
+            ),
+            content_type='application/x-ndjson',
+        )
+        return self._stamp_cooked_version(response, field_name)
+
+    def _stamp_cooked_version(self, response, field_name):
+        response['X-Cooked-Version'] = get_cooked_version(
+            self.model._meta.get_field(field_name).remote_field.model)
+        return response
+
+    def watch_cooked_fields(self):
+        """ Keep cooked version stamps current for self.cooked_id_fields """
+        for field_name in self.cooked_id_fields:
+            watch_cooked_model(
+                self.model._meta.get_field(field_name).remote_field.model)
+
+    def _parse_cooked_ids(self, raw_ids):
         try:
-            ids = list(map(int, raw_ids.split(',')))
+            return list(map(int, raw_ids.split(',')))
         except ValueError:
             if raw_ids == '':
-                ids = []
+                return []
             else:
                 raise http.Http404
+
+    def _iter_cooked_chunks(self, request, field_name, ids):
+        """
+        Yields dicts of cooked data (keyed by pk), looking up at most
+        `cooked_id_chunk_size` ids per query.
+        """
         target_model_admin = self.admin_site._registry.get(
-            self.model._meta.get_field(field_name).rel.to)
-        response_data = {}
-        if (
+            self.model._meta.get_field(field_name).remote_field.model)
+        if not (
                 target_model_admin and
                 target_model_admin.has_change_permission(request)
         ):
-            for obj in target_model_admin.get_queryset(request).filter(id__in=ids):
-                response_data[obj.pk] = self.cook(
+            return # graceful-ish.
+        queryset = target_model_admin.get_queryset(request)
+        chunk_size = self.cooked_id_chunk_size
+        for start in range(0, len(ids), chunk_size):
+            chunk = {}
+            for obj in queryset.filter(id__in=ids[start:start + chunk_size]):
+                chunk[obj.pk] = self.cook(
                     obj, request=request, field_name=field_name)
-        else:
-            pass # graceful-ish.
-
-        content_type_kwarg = (
-            'content_type' if django.VERSION >= (1,7) else 'mimetype'
-        )
-        return http.HttpResponse(
-            json.dumps(response_data),
-            **{content_type_kwarg: 'application/json'}
-        )
+            if chunk:
+                yield chunk
 
     def assert_cooked_target_admin(self, db_field):
-        if db_field.rel.to in self.admin_site._registry:
+        if db_field.remote_field.model in self.admin_site._registry:
             return True
         else:
             if settings.DEBUG:
@@ -98,7 +160,7 @@ class BaseCookedIdAdmin:
                     "is not registed in the same admin site." % (
                         self.__class__.__name__,
                         db_field.name,
-                        db_field.rel.to,
+                        db_field.remote_field.model,
                     )
                 )
             else:
@@ -107,24 +169,44 @@ class BaseCookedIdAdmin:
 
 class CookedIdAdmin(BaseCookedIdAdmin, admin.ModelAdmin):
 
+    def __init__(self, *args, **kwargs):
+        super(CookedIdAdmin, self).__init__(*args, **kwargs)
+        # connected here (i.e. at registration) so that every process with
+        # the admin loaded bumps version stamps, not just those serving it
+        self.watch_cooked_fields()
+        for inline_class in self.inlines:
+            if getattr(inline_class, 'cooked_id_fields', None):
+                inline_class(self.model, self.admin_site).watch_cooked_fields()
+
     def cook_ids_inline(self, request, model_name, field_name, raw_ids):
         
-        # find the correct inline instance and pass control to it's own cook_ids()
+        inline = self._get_cooked_inline(request, model_name, field_name)
+        return inline.cook_ids(request, field_name, raw_ids)
+
+    def _get_cooked_inline(self, request, model_name, field_name):
+        # find the correct inline instance so control can pass to it
         inlines = self.get_inline_instances(request)
         for inline in inlines:
             content_type = ContentType.objects.get_for_model(inline.model)
             if model_name == content_type.model and field_name in inline.cooked_id_fields:
                 # this is our guy
-                return inline.cook_ids(request, field_name, raw_ids)
+                return inline
 
         raise http.Http404
 
+    def cook_ids_inline_post(self, request, model_name, field_name):
+        inline = self._get_cooked_inline(request, model_name, field_name)
+        return inline.cook_ids_post(request, field_name)
+
     def get_urls(self):
 
         urlpatterns = [
             url(r'^cook-ids/(?P<field_name>\w+)/(?P<raw_ids>[\d,]+)/$',
                 self.admin_site.admin_view(self.cook_ids)
-            )
+            ),
+            url(r'^cook-ids/(?P<field_name>\w+)/$',
+                self.admin_site.admin_view(self.cook_ids_post)
+            ),
         ]
 
         # add any inline cooked ID urls...
@@ -136,7 +218,10 @@ class CookedIdAdmin(BaseCookedIdAdmin, admin.ModelAdmin):
                     urlpatterns += [
                         url(r'^cook-ids-inline/(?P<model_name>'+content_type.model+')/(?P<field_name>\w+)/(?P<raw_ids>[\d,]+)/$',
                             self.admin_site.admin_view(self.cook_ids_inline)
-                        )
+                        ),
+                        url(r'^cook-ids-inline/(?P<model_name>'+content_type.model+')/(?P<field_name>\w+)/$',
+                            self.admin_site.admin_view(self.cook_ids_inline_post)
+                        ),
                     ]
             except AttributeError:
                 # probably not a TabularInlineCookedIdAdmin
@@ -148,7 +233,7 @@ class CookedIdAdmin(BaseCookedIdAdmin, admin.ModelAdmin):
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = ManyToManyCookedIdWidget(
-                    db_field.rel, self.admin_site)
+                    db_field.remote_field, self.admin_site)
         return super(CookedIdAdmin, self).formfield_for_manytomany(
             db_field, request=request, **kwargs)
 
@@ -156,7 +241,7 @@ class CookedIdAdmin(BaseCookedIdAdmin, admin.ModelAdmin):
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = ForeignKeyCookedIdWidget(
-                    db_field.rel, self.admin_site)
+                    db_field.remote_field, self.admin_site)
         return super(CookedIdAdmin, self).formfield_for_foreignkey(
             db_field, request=request, **kwargs)
 
@@ -170,7 +255,7 @@ class TabularInlineCookedIdAdmin(BaseCookedIdAdmin, admin.TabularInline):
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = TabularInlineManyToManyCookedIdWidget(
-                    db_field.rel, self.admin_site, {
+                    db_field.remote_field, self.admin_site, {
                         'data-model': content_type.model,
                         'data-field': db_field.name,
                     })
@@ -182,7 +267,7 @@ class TabularInlineCookedIdAdmin(BaseCookedIdAdmin, admin.TabularInline):
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = TabularInlineForeignKeyCookedIdWidget(
-                    db_field.rel, self.admin_site, {
+                    db_field.remote_field, self.admin_site, {
                         'data-model': content_type.model,
                         'data-field': db_field.name,
                     })
@@ -199,7 +284,7 @@ class StackedInlineCookedIdAdmin(BaseCookedIdAdmin, admin.StackedInline):
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = StackedInlineManyToManyCookedIdWidget(
-                    db_field.rel, self.admin_site, {
+                    db_field.remote_field, self.admin_site, {
                         'data-model': content_type.model,
                         'data-field': db_field.name,
                     })
@@ -211,7 +296,7 @@ class StackedInlineCookedIdAdmin(BaseCookedIdAdmin, admin.StackedInline):
         if db_field.name in self.cooked_id_fields:
             if self.assert_cooked_target_admin(db_field):
                 kwargs['widget'] = StackedInlineForeignKeyCookedIdWidget(
-                    db_field.rel, self.admin_site, {
+                    db_field.remote_field, self.admin_site, {
                         'data-model': content_type.model,
                         'data-field': db_field.name,
                     })
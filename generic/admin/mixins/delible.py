@@ -1,26 +1,144 @@
+from collections import defaultdict
+
 from django import http
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.admin.utils import model_ngettext, quote
 from django.conf.urls import url
 from django.shortcuts import get_object_or_404, redirect
+from django.urls import NoReverseMatch, reverse
+from django.utils.html import format_html
+from django.utils.text import capfirst
 
-from ...models.delible import Delible
+from ...models.delible import (
+    Delible,
+    DelibleManager,
+    DelibleQuerySet,
+    get_cascade,
+    get_soft_delete_cascade,
+)
 class DelibleAdmin(admin.ModelAdmin):
     """ Admin with "undelete" functionality for Delible objects """
     change_form_template = 'admin/delible_change_form.html'
 
+    def get_queryset(self, request):
+        if not getattr(request, '_delible_include_deleted', False):
+            return super(DelibleAdmin, self).get_queryset(request)
+        # as ModelAdmin.get_queryset(), less DelibleManager's filtering
+        manager = self.model._default_manager
+        if isinstance(manager, DelibleManager):
+            queryset = manager.all_with_deleted()
+        else:
+            queryset = manager.get_queryset()
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
+    def get_undelete_queryset(self, request):
+        """
+        Returns the deleted objects `request` may undelete: those of
+        get_queryset() (so restricted likewise) but for the deleted=None
+        filter. Override to restrict further.
+        """
+        request._delible_include_deleted = True
+        try:
+            return self.get_queryset(request).exclude(deleted=None)
+        finally:
+            del request._delible_include_deleted
+
     def delete_model(self, request, obj):
         if isinstance(obj, Delible):
             obj.delete(request=request)
         else:
             obj.delete()
 
+    def delete_queryset(self, request, queryset):
+        if issubclass(self.model, Delible):
+            get_delible_queryset(queryset).delete(request=request)
+        else:
+            queryset.delete()
+
+    def get_deleted_objects(self, objs, request):
+        """
+        Lists what "deleting" `objs` hides, including any soft delete
+        cascade, rather than the hard-delete cascade Django collects, which
+        would list (and demand permission to delete) related objects that are
+        left alone.
+        """
+        if not issubclass(self.model, Delible):
+            return super(DelibleAdmin, self).get_deleted_objects(
+                objs, request)
+        model_count = defaultdict(int)
+        perms_needed = set()
+
+        def format_object(obj):
+            opts = obj._meta
+            model_count[opts.verbose_name_plural] += 1
+            no_edit_link = '%s: %s' % (capfirst(opts.verbose_name), obj)
+            model_admin = self.admin_site._registry.get(obj.__class__)
+            if model_admin is None:
+                return no_edit_link
+            if not model_admin.has_delete_permission(request, obj):
+                perms_needed.add(opts.verbose_name)
+            try:
+                admin_url = reverse(
+                    '%s:%s_%s_change' % (
+                        self.admin_site.name,
+                        opts.app_label,
+                        opts.model_name,
+                    ),
+                    args=(quote(obj.pk),),
+                )
+            except NoReverseMatch:
+                return no_edit_link
+            return format_html(
+                '{}: <a href="{}">{}</a>',
+                capfirst(opts.verbose_name), admin_url, obj)
+
+        if get_cascade(self.model):
+            cascade = get_soft_delete_cascade(
+                self.model._meta.concrete_model, objs)
+        else:
+            cascade = {}
+
+        def nested(obj):
+            # as per django.contrib.admin.utils.NestedObjects.nested()
+            children = []
+            for child in cascade.get(obj, ()):
+                children.extend(nested(child))
+            return [format_object(obj)] + ([children] if children else [])
+
+        deleted_objects = []
+        for obj in objs:
+            deleted_objects.extend(nested(obj))
+        return deleted_objects, dict(model_count), perms_needed, []
+
+    def undelete_selected(self, request, queryset):
+        if not request.POST.get('select_across'):
+            # the change list's queryset may well exclude deleted objects
+            queryset = self.get_undelete_queryset(request).filter(
+                pk__in=request.POST.getlist(helpers.ACTION_CHECKBOX_NAME))
+        count = get_delible_queryset(queryset).undelete()
+        self.message_user(request, 'Undeleted %d %s.' % (
+            count, model_ngettext(self.model, count)))
+    undelete_selected.allowed_permissions = ('delete',)
+    undelete_selected.short_description = 'Undelete selected %(verbose_name_plural)s'
+
+    def get_actions(self, request):
+        actions = super(DelibleAdmin, self).get_actions(request)
+        if issubclass(self.model, Delible) and 'delete_selected' in actions:
+            actions['undelete_selected'] = self.get_action('undelete_selected')
+        return actions
+
     def undelete(self, request, pk):
         permission = '%s.delete_%s' % (
             self.model._meta.app_label, self.model._meta.model_name)
         if not request.user.has_perm(permission):
             return http.HttpResponseForbidden()
         else:
-            obj = get_object_or_404(self.model, pk=pk)
+            obj = get_object_or_404(
+                self.get_undelete_queryset(request), pk=pk)
             try:
                 obj.undelete()
             except AttributeError:
@@ -45,3 +163,10 @@ class DelibleAdmin(admin.ModelAdmin):
             ] + urls
         return urls
 
+
+def get_delible_queryset(queryset):
+    """ Returns `queryset` as a DelibleQuerySet, for set-based (un)deletion """
+    if isinstance(queryset, DelibleQuerySet):
+        return queryset
+    return DelibleQuerySet(
+        queryset.model, query=queryset.query.chain(), using=queryset.db)
@@ -0,0 +1,58 @@
+from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.forms.models import ModelChoiceIterator
+
+from ...mixins import Inheritable, get_leaf_objects
+from ...utils.inheritance import with_results
+
+
+class LeafModelChoiceIterator(ModelChoiceIterator):
+    """ Labels choices using leaf instances, resolved in bulk """
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for obj in get_leaf_objects(self.queryset):
+            yield self.choice(obj)
+
+
+class LeafChangeList(ChangeList):
+
+    def get_results(self, request):
+        super(LeafChangeList, self).get_results(request)
+        self.result_list = with_results(
+            self.result_list, get_leaf_objects(self.result_list))
+
+
+class InheritableAdmin(admin.ModelAdmin):
+    """
+    Resolves leaf instances of Inheritable objects in bulk, for changelist
+    rows and for relation choices, so that their __str__ (which displays the
+    leaf object) doesn't cost queries per object.
+    """
+
+    def get_changelist(self, request, **kwargs):
+        if issubclass(self.model, Inheritable):
+            return LeafChangeList
+        return super(InheritableAdmin, self).get_changelist(request, **kwargs)
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        return self._use_leaf_choices(
+            db_field,
+            super(InheritableAdmin, self).formfield_for_foreignkey(
+                db_field, request=request, **kwargs)
+        )
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        return self._use_leaf_choices(
+            db_field,
+            super(InheritableAdmin, self).formfield_for_manytomany(
+                db_field, request=request, **kwargs)
+        )
+
+    def _use_leaf_choices(self, db_field, formfield):
+        if formfield is not None and issubclass(
+                db_field.remote_field.model, Inheritable):
+            formfield.iterator = LeafModelChoiceIterator
+            formfield.widget.choices = formfield.choices
+        return formfield
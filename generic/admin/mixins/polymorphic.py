@@ -1,7 +1,19 @@
+import hashlib
+from collections import OrderedDict, defaultdict
+
 from django import forms
 from django import http
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
 from django.contrib.admin.filters import SimpleListFilter
+from django.contrib.admin.utils import model_ngettext, prepare_lookup_value
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import router, transaction
+from django.db.models import Count, Q
+from django.db.models.deletion import Collector, ProtectedError
+from django.template.response import TemplateResponse
 try:
     from django.apps import apps
     get_model = apps.get_model
@@ -9,48 +21,180 @@ try:
 except ImportError:
     from django.db.models.loading import get_model, get_models
 from django.apps import apps
-from django.utils.translation import ugettext_lazy as _
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext, ugettext_lazy as _
 
 from django.conf.urls import url
 
-from ...utils.inheritance import get_subclasses
+from ...mixins import SubclassTypeMixin
+from ...utils.inheritance import get_subclasses, registry, with_results
 
 
 def get_subclass_choices(parent_model):
-    title_if_lower = lambda s: (s.title() if s == s.lower() else s)
-    return sorted(
-        [(
-                model._meta.model_name,
-                title_if_lower(model._meta.verbose_name),
-            ) for model in [model for model in get_models() if (
-                    issubclass(model, parent_model) and
-                    parent_model in model._meta.parents
-                )]]
-    )
+    return registry.get_subclass_choices(parent_model)
 
 class SubclassFilter(SimpleListFilter):
+    """
+    Filters by direct subclass. Set show_counts to display the number of
+    objects of each type, computed in a single aggregate query over the
+    changelist's queryset as filtered by everything (other list filters,
+    search etc.) but this filter. Counts are cached for counts_cache_timeout
+    seconds, if set.
+    """
     title = _('Type')
     parameter_name = 'type'
+    show_counts = False
+    counts_cache_timeout = None
+
+    def __init__(self, request, *args, **kwargs):
+        self.request = request # for get_counted_queryset()
+        super(SubclassFilter, self).__init__(request, *args, **kwargs)
 
     def lookups(self, request, model_admin):
         return get_subclass_choices(model_admin.model)
 
     def queryset(self, request, queryset):
         if self.value():
+            subclass = registry.get_subclass(queryset.model, self.value())
+            if subclass and issubclass(queryset.model, SubclassTypeMixin):
+                # single-table lookup on the indexed discriminator
+                subclass = subclass._meta.concrete_model
+                return queryset.filter(subclass_type__in=[
+                    model._meta.label_lower for model in
+                    (subclass,) + registry.get_descendants(subclass)
+                ])
             return queryset.complex_filter(
                 {'%s__isnull' % self.value(): False})
         else:
             return queryset
 
+    def choices(self, changelist):
+        choices = super(SubclassFilter, self).choices(changelist)
+        if not self.show_counts:
+            for choice in choices:
+                yield choice
+            return
+        counts = self.get_counts(self.get_counted_queryset(changelist))
+        yield next(choices) # "All"
+        for (lookup, title), choice in zip(self.lookup_choices, choices):
+            choice['display'] = '%s (%d)' % (title, counts.get(lookup, 0))
+            yield choice
+
+    def get_counted_queryset(self, changelist):
+        """
+        Returns `changelist`'s queryset, less this filter's filtering: its
+        root queryset as filtered by the other list filters, the remaining
+        lookup parameters and the search, as ChangeList.get_queryset() does,
+        but reusing the changelist's filters rather than building them (and
+        running their lookups) again.
+        """
+        if self.value() is None:
+            return changelist.queryset
+        lookup_params = changelist.get_filters_params()
+        for spec in changelist.filter_specs:
+            for parameter in spec.expected_parameters():
+                lookup_params.pop(parameter, None)
+        queryset = changelist.root_queryset
+        for spec in changelist.filter_specs:
+            if spec is not self:
+                filtered = spec.queryset(self.request, queryset)
+                if filtered is not None:
+                    queryset = filtered
+        try:
+            queryset = queryset.filter(**dict(
+                (key, prepare_lookup_value(key, value))
+                for key, value in lookup_params.items()
+            ))
+        except Exception:
+            # e.g. a parameter of a filter without output, and so not among
+            # filter_specs; let the changelist sort it out
+            return self.get_changelist_queryset(changelist)
+        queryset, use_distinct = changelist.model_admin.get_search_results(
+            self.request, queryset, changelist.query)
+        if use_distinct or changelist.queryset.query.distinct:
+            queryset = queryset.distinct()
+        return queryset
+
+    def get_changelist_queryset(self, changelist):
+        """ Has `changelist` build its queryset without this filter's value """
+        state = (
+            changelist.params, changelist.filter_specs, changelist.has_filters)
+        changelist.params = dict(changelist.params)
+        del changelist.params[self.parameter_name]
+        try:
+            return changelist.get_queryset(self.request)
+        finally:
+            (changelist.params, changelist.filter_specs,
+             changelist.has_filters) = state
+
+    def get_counts(self, queryset):
+        """ Returns a {lookup: number of objects} mapping """
+        cache_key = None
+        if self.counts_cache_timeout:
+            try:
+                sql = force_text(queryset.query)
+            except Exception: # e.g. EmptyResultSet
+                pass
+            else:
+                cache_key = 'generic-subclass-counts-%s' % hashlib.md5(
+                    sql.encode('utf-8')).hexdigest()
+                counts = cache.get(cache_key)
+                if counts is not None:
+                    return counts
+        queryset = queryset.order_by()
+        lookups = [lookup for lookup, title in self.lookup_choices]
+        if issubclass(queryset.model, SubclassTypeMixin):
+            type_counts = dict(
+                queryset.values_list('subclass_type').annotate(Count('pk')))
+            counts = {}
+            for lookup in lookups:
+                subclass = registry.get_subclass(queryset.model, lookup)
+                subclass = subclass._meta.concrete_model
+                counts[lookup] = sum(
+                    type_counts.get(model._meta.label_lower, 0) for model in
+                    (subclass,) + registry.get_descendants(subclass)
+                )
+        else:
+            aggregates = queryset.aggregate(**dict(
+                (
+                    'count_%s' % lookup,
+                    Count('pk', filter=Q(**{'%s__isnull' % lookup: False})),
+                ) for lookup in lookups
+            ))
+            counts = dict(
+                (lookup, aggregates['count_%s' % lookup]) for lookup in lookups)
+        if cache_key:
+            cache.set(cache_key, counts, self.counts_cache_timeout)
+        return counts
+
+
+class PolymorphicChangeList(ChangeList):
+    """ Resolves subclass instances for the displayed page only """
+
+    def get_results(self, request):
+        super(PolymorphicChangeList, self).get_results(request)
+        self.result_list = with_results(
+            self.result_list,
+            self.model_admin.resolve_subclasses(self.result_list),
+        )
+
 
 class PolymorphicAdmin(admin.ModelAdmin):
     """
     For use with django-model-utils' InheritanceManager.
+
+    If the model uses generic.mixins.SubclassTypeMixin, SubclassFilter uses
+    its `subclass_type` discriminator rather than joining child tables.
+
+    Set lazy_subclass_resolution to query only the base table for changelist
+    pages and counts, then fetch subclass instances for the visible page (see
+    resolve_subclasses) rather than joining every child table.
     """
 
     list_filter = (SubclassFilter,)
     subclass_parameter_name = '__subclass'
     subclass_label = _('Type')
+    lazy_subclass_resolution = False
 
     def add_view(self, request, form_url='', extra_context=None):
         if self.subclass_parameter_name in request.POST:
@@ -71,15 +215,25 @@ class PolymorphicAdmin(admin.ModelAdmin):
             return (
                 (None, {'fields': (self.subclass_parameter_name,)},),
             )
-        return self.get_modeladmin(request, obj).get_fieldsets(request, obj)
+        return self._memoise(
+            request, ('fieldsets', self._obj_key(obj)),
+            lambda: self.get_modeladmin(request, obj).get_fieldsets(
+                request, obj)
+        )
 
     def get_readonly_fields(self, request, obj=None):
-        model_admin = self.get_modeladmin(request, obj)
-        return model_admin.get_readonly_fields(request, obj)
+        return self._memoise(
+            request, ('readonly_fields', self._obj_key(obj)),
+            lambda: self.get_modeladmin(request, obj).get_readonly_fields(
+                request, obj)
+        )
 
     def get_inline_instances(self, request, obj=None):
-        model_admin = self.get_modeladmin(request, obj)
-        return model_admin.get_inline_instances(request, obj)
+        return self._memoise(
+            request, ('inline_instances', self._obj_key(obj)),
+            lambda: self.get_modeladmin(request, obj).get_inline_instances(
+                request, obj)
+        )
 
     def get_formsets(self, request, obj=None):
         if not self.get_model(request, obj):
@@ -88,6 +242,15 @@ class PolymorphicAdmin(admin.ModelAdmin):
         return model_admin.get_formsets(request, obj)
 
     def get_form(self, request, obj=None, **kwargs):
+        key = (
+            'form',
+            self._obj_key(obj),
+            tuple(sorted((name, repr(value)) for name, value in kwargs.items())),
+        )
+        return self._memoise(
+            request, key, lambda: self._get_form(request, obj, **kwargs))
+
+    def _get_form(self, request, obj=None, **kwargs):
         model_admin = self.get_modeladmin(request, obj)
         form_class = model_admin.get_form(request, obj=obj, **kwargs)
         if not self.get_model(request, obj):
@@ -96,26 +259,68 @@ class PolymorphicAdmin(admin.ModelAdmin):
             return form_class
 
     def get_model(self, request, obj=None):
-        return obj.__class__ if obj else (
-            loading.get_model(
-                self.opts.app_label,
-                request.REQUEST.get(self.subclass_parameter_name, '')
-            )
+        if obj:
+            return obj.__class__
+        return self._memoise(request, 'model', lambda: self._get_model(request))
+
+    def _get_model(self, request):
+        model_name = request.POST.get(
+            self.subclass_parameter_name,
+            request.GET.get(self.subclass_parameter_name, '')
         )
+        if not model_name:
+            return None
+        try:
+            return get_model(self.opts.app_label, model_name)
+        except LookupError:
+            return None
 
     def get_modeladmin(self, request, obj=None):
         model = self.get_model(request, obj)
         if model and model != self.model:
-            return self.admin_site._registry.get(
-                model, # use registered admin if it exists...
+            try:
+                # use registered admin if it exists...
+                return self.admin_site._registry[model]
+            except KeyError:
+                pass
+            try:
+                return self._subclass_admins[model]
+            except AttributeError:
+                self._subclass_admins = {}
+            except KeyError:
+                pass
+            model_admin = self._subclass_admins[model] = (
                 self.get_unregistered_admin_classes().get(
                     model, # or unregistered one if we know about it
                     self.__class__ # ...or build a generic one
                 )(model, self.admin_site)
             )
+            return model_admin
         else:
             return super(PolymorphicAdmin, self)
 
+    def _memoise(self, request, key, compute):
+        """
+        Caches compute() for the duration of `request`, since Django asks for
+        the same fieldsets, forms etc. several times per change form request.
+        """
+        cache = self._get_request_cache(request)
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = compute()
+            return value
+
+    def _get_request_cache(self, request):
+        try:
+            caches = request._polymorphic_admin_cache
+        except AttributeError:
+            caches = request._polymorphic_admin_cache = {}
+        return caches.setdefault(self, {})
+
+    def _obj_key(self, obj):
+        return None if obj is None else (obj.__class__, obj.pk)
+
     def get_unregistered_admin_classes(self):
         return {
             # override with Model: ModelAdmin mapping
@@ -131,12 +336,161 @@ class PolymorphicAdmin(admin.ModelAdmin):
                 )
         return SubclassSelectionForm
 
-    # TODO: disable bulk deletion action when heterogeneous classes selected
-    # -- collector doesn't cope, and raises AttributeErrors
+    def get_actions(self, request):
+        """
+        Replaces the standard bulk deletion action, whose collector doesn't
+        cope with heterogeneous subclasses (it raises AttributeErrors).
+        """
+        actions = super(PolymorphicAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            del actions['delete_selected']
+            actions = OrderedDict(
+                [(
+                    'delete_selected_subclasses',
+                    self.get_action('delete_selected_subclasses'),
+                )] + list(actions.items())
+            )
+        return actions
+
+    def delete_selected_subclasses(self, request, queryset):
+        """
+        Deletes the selection grouped by concrete subclass, with one collector
+        pass per group. The confirmation page lists counts per group.
+        """
+        opts = self.model._meta
+        objects = self.resolve_subclasses(queryset)
+        objects_by_model = OrderedDict()
+        for obj in objects:
+            objects_by_model.setdefault(obj.__class__, []).append(obj)
+
+        groups = []
+        perms_needed = set()
+        protected = []
+        for model, model_objects in objects_by_model.items():
+            collector = Collector(using=router.db_for_write(model))
+            try:
+                collector.collect(model_objects)
+            except ProtectedError as e:
+                protected.extend(e.protected_objects)
+                continue
+            model_count = OrderedDict()
+            for related_model, instances in collector.data.items():
+                model_count[related_model] = len(instances)
+            for fast_delete in collector.fast_deletes:
+                model_count[fast_delete.model] = (
+                    model_count.get(fast_delete.model, 0) + fast_delete.count())
+            for related_model in model_count:
+                related_admin = self.admin_site._registry.get(related_model)
+                if related_admin and not related_admin.has_delete_permission(
+                        request):
+                    perms_needed.add(related_model._meta.verbose_name)
+            groups.append({
+                'opts': model._meta,
+                'objects': model_objects,
+                'collector': collector,
+                'model_count': [
+                    (related_model._meta.verbose_name_plural, count)
+                    for related_model, count in model_count.items() if count
+                ],
+            })
+
+        if request.POST.get('post') and not protected:
+            if perms_needed:
+                raise PermissionDenied
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                for group in groups:
+                    for obj in group['objects']:
+                        self.log_deletion(request, obj, force_text(obj))
+                    group['collector'].delete()
+            if objects:
+                self.message_user(
+                    request,
+                    ugettext('Successfully deleted %(count)d %(items)s.') % {
+                        'count': len(objects),
+                        'items': model_ngettext(opts, len(objects)),
+                    },
+                    messages.SUCCESS,
+                )
+            return None # display the change list page again
+
+        objects_name = model_ngettext(opts, len(objects))
+        return TemplateResponse(
+            request,
+            [
+                'admin/%s/%s/delete_selected_subclasses_confirmation.html' % (
+                    opts.app_label, opts.model_name),
+                'admin/%s/delete_selected_subclasses_confirmation.html' % (
+                    opts.app_label),
+                'admin/generic/delete_selected_subclasses_confirmation.html',
+            ],
+            dict(
+                self.admin_site.each_context(request),
+                title=(
+                    ugettext('Cannot delete %(name)s') % {
+                        'name': objects_name}
+                    if perms_needed or protected else
+                    ugettext('Are you sure?')
+                ),
+                opts=opts,
+                objects_name=force_text(objects_name),
+                groups=groups,
+                objects=objects,
+                perms_lacking=sorted(perms_needed),
+                protected=protected,
+                action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+                media=self.media,
+            ),
+        )
+    delete_selected_subclasses.short_description = _(
+        'Delete selected %(verbose_name_plural)s')
 
     def get_queryset(self, request):
+        if self._get_request_cache(request).get('lazy_changelist'):
+            return self.model.objects.all()
         return self.model.objects.select_subclasses()
 
+    def changelist_view(self, request, extra_context=None):
+        if self.lazy_subclass_resolution:
+            self._get_request_cache(request)['lazy_changelist'] = True
+        return super(PolymorphicAdmin, self).changelist_view(
+            request, extra_context=extra_context)
+
+    def get_changelist(self, request, **kwargs):
+        if self.lazy_subclass_resolution:
+            return PolymorphicChangeList
+        return super(PolymorphicAdmin, self).get_changelist(request, **kwargs)
+
+    def resolve_subclasses(self, objects):
+        """
+        Returns base model `objects` as instances of their subclasses, in the
+        same order. With a `subclass_type` discriminator this takes one query
+        per subclass present; otherwise a single select_subclasses() query
+        restricted to the objects' pks.
+        """
+        objects = list(objects)
+        pks_by_model = defaultdict(list)
+        unknown_pks = []
+        for obj in objects:
+            if obj.__class__ is not self.model:
+                continue # already resolved, e.g. by select_subclasses()
+            try:
+                model = apps.get_model(obj.subclass_type)
+            except (AttributeError, LookupError, ValueError):
+                unknown_pks.append(obj.pk)
+            else:
+                if model is not obj.__class__:
+                    pks_by_model[model].append(obj.pk)
+        resolved = {}
+        for model, pks in pks_by_model.items():
+            resolved.update(model._base_manager.in_bulk(pks))
+        if unknown_pks:
+            resolved.update(
+                (obj.pk, obj) for obj in
+                self.model.objects.select_subclasses().filter(
+                    pk__in=unknown_pks)
+            )
+        return [resolved.get(obj.pk, obj) for obj in objects]
+
     def get_urls(self, *args, **kwargs):
         """
         To make sure that save and continue editing works when adding new
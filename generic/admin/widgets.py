@@ -1,7 +1,44 @@
+import uuid
+
 from django.contrib.admin.widgets import (
      ManyToManyRawIdWidget, ForeignKeyRawIdWidget)
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.utils.safestring import mark_safe
 
+
+def get_cooked_version(model):
+    """
+    Returns the current version stamp for cooked representations of `model`
+    objects; cooked_id_widgets.js drops cached data with any other stamp.
+    """
+    cache_key = 'generic-cooked-version-%s' % model._meta.label_lower
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, uuid.uuid4().hex[:8], None)
+        version = cache.get(cache_key)
+    return version
+
+
+def bump_cooked_version(sender, **kwargs):
+    cache.set(
+        'generic-cooked-version-%s' % sender._meta.label_lower,
+        uuid.uuid4().hex[:8],
+        None
+    )
+
+
+def watch_cooked_model(model):
+    """ Bump the cooked version stamp whenever a `model` object changes """
+    for signal in (post_save, post_delete):
+        signal.connect(
+            bump_cooked_version,
+            sender=model,
+            dispatch_uid='generic-cooked-version-%s' % (
+                model._meta.label_lower),
+        )
+
+
 class ForeignKeyCookedIdWidget(ForeignKeyRawIdWidget):
     """
     For situations where RawIdWidgets are a bit too... well, raw.
@@ -10,6 +47,10 @@ class ForeignKeyCookedIdWidget(ForeignKeyRawIdWidget):
         return '' # avoid displaying normal <strong>value</strong>
 
     def render(self, name, value, attrs=None):
+        model = self.rel.model
+        attrs = dict(attrs or {})
+        attrs['data-cooked-model'] = model._meta.label_lower
+        attrs['data-cooked-version'] = get_cooked_version(model)
         output = super(ForeignKeyCookedIdWidget, self).render(
             name, value, attrs)
         output = output.replace(
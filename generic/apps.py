@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class GenericConfig(AppConfig):
+    name = 'generic'
+    verbose_name = 'Generic'
+
+    def ready(self):
+        from .utils.inheritance import registry
+        registry.build()
@@ -3,7 +3,11 @@ try:
 except ImportError:
     from django.utils import simplejson as json
 
+from collections import OrderedDict
 from functools import wraps
+import math
+import random
+import time
 import django
 from django.conf import settings
 try:
@@ -12,63 +16,332 @@ except ImportError:
     from django.core.cache import cache, caches
     def get_cache(name):
         return caches[name]
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.http import HttpResponse
 
+from .utils.cache import (
+    MAX_CACHE_KEY_LENGTH,
+    CacheMethodStats,
+    LocalCache,
+    fetch_generations,
+    get_generation,
+    get_safe_cache_key,
+    uses_generations,
+)
+
 import logging
 logger = logging.getLogger(__name__)
 
-def cache_method(cache_name=None):
+class CachedValue(object):
+    """
+    Wraps values stored by cache_method, so that a cached None can be told
+    apart from a miss with a single get, along with when the value should be
+    recomputed and how long that took (for stampede protection).
+    """
+    expires = None
+    delta = 0
+
+    def __init__(self, value, expires=None, delta=0):
+        self.value = value
+        self.expires = expires
+        self.delta = delta
+
+    def is_stale(self, early_recompute=None):
+        """
+        Whether the value is due for recomputation; with `early_recompute`,
+        possibly a little early -- the more likely the closer to expiry and
+        the longer the value took to compute.
+        """
+        if self.expires is None:
+            return False
+        now = time.time()
+        if early_recompute:
+            now -= self.delta * early_recompute * math.log(
+                1 - random.random())
+        return now >= self.expires
+
+
+def acquire_lease(cache_obj, cache_key, timeout):
+    """ Claims the right to recompute `cache_key`, if nobody else has it """
+    try:
+        return cache_obj.add('%s-lease' % cache_key, 1, timeout)
+    except Exception as e:
+        logger.warning('Cache error: {0}'.format(e))
+        return True
+
+
+def release_lease(cache_obj, cache_key):
+    try:
+        cache_obj.delete('%s-lease' % cache_key)
+    except Exception as e:
+        logger.warning('Cache error: {0}'.format(e))
+
+
+def get_cache_method_key(obj, method_name, args, kwargs, generation=None):
+    """
+    Returns cache_method's key for calling `method_name` on `obj` with `args`
+    and `kwargs`, hashed if too long or otherwise unsafe for memcached.
+    """
+    cache_key = 'generic-%s-%s-%s' % (
+        obj.__class__.__name__,
+        obj.pk,
+        method_name,
+    )
+    for value in args:
+        if isinstance(value, (list, tuple)):
+            value = ','.join(map(str, value))
+        cache_key += '-%s' % value
+    for key, value in sorted(kwargs.items()):
+        if isinstance(value, (list, tuple)):
+            value = ','.join(map(str, value))
+        cache_key += '-%s=%s' % (key, value)
+    if generation is not None:
+        cache_key += '-g%s' % generation
+    return get_safe_cache_key(cache_key, prefix='generic-%s-%s' % (
+        obj.__class__.__name__, method_name))
+
+
+def cache_method(cache_name=None, timeout=DEFAULT_TIMEOUT, stale_timeout=None,
+                 early_recompute=None, lease_timeout=30, local_timeout=None,
+                 local_size=1000, invalidate_on_save=None):
     """
     Caches the result of a method for its object instance using the passed
-    arguments to generate a cache key
+    arguments to generate a cache key. `timeout` defaults to the cache's own.
+
+    Optional stampede protection, so that popular values expiring don't have
+    every process recompute them at once:
+     - `stale_timeout`: keep values this many seconds beyond `timeout`, while
+       one caller recomputes them and the rest get the stale value
+     - `early_recompute`: a factor (1 is typical) for recomputing values
+       before they expire, at random but increasingly likely as expiry
+       approaches, with the rest getting the current value
+    Either way recomputation is claimed with a `lease_timeout` second lease.
+
+    With `local_timeout`, results are also kept in an in-process LRU cache of
+    up to `local_size` entries for that many seconds, sparing cache round
+    trips for repeated calls (e.g. from templates). Keep it short: other
+    processes only see invalidation once their local entries expire.
+
+    Use wrapped_method.invalidate(obj, *args, **kwargs) to forget a result
+    in both tiers.
+
+    Hits, misses, cache errors, compute times and (for the fraction of misses
+    in settings.GENERIC_CACHE_METHOD_STATS_PAYLOAD, default none) result
+    sizes are counted in wrapped_method.stats; see
+    generic.utils.cache.get_cache_method_stats() and the `cache_method_stats`
+    management command.
+
+    With `invalidate_on_save` (default: settings.
+    GENERIC_CACHE_METHOD_INVALIDATE_ON_SAVE), keys of model instances include
+    a generation which is replaced whenever the instance is saved or deleted,
+    forgetting all of its cached results at once. The generation is fetched
+    once per instance (object), so a stale instance may see stale results.
     """
+    options = {
+        'cache_name': cache_name,
+        'invalidate_on_save': invalidate_on_save,
+    }
+
     def inner(method):
+        local_cache = LocalCache(
+            local_size, local_timeout) if local_timeout else None
+        stats = CacheMethodStats(
+            '%s.%s' % (method.__module__, method.__qualname__))
+
+        def get_cache_obj():
+            return get_cache(cache_name) if cache_name else cache
+
+        def get_key(obj, args, kwargs):
+            generation = None
+            if hasattr(obj, '_meta') and uses_generations(options):
+                generation = get_generation(obj, cache_name)
+            return get_cache_method_key(
+                obj, method.__name__, args, kwargs, generation)
+
+        def get_timeouts(cache_obj):
+            """ Returns (soft expiry, cache timeout) for new entries """
+            soft_timeout = (
+                cache_obj.default_timeout if timeout is DEFAULT_TIMEOUT
+                else timeout)
+            if soft_timeout is None or not (stale_timeout or early_recompute):
+                return None, soft_timeout
+            return soft_timeout, soft_timeout + (stale_timeout or 0)
+
+        def compute(obj, args, kwargs, cache_obj):
+            """ Returns a CachedValue of the method's result """
+            started = time.time()
+            entry = CachedValue(method(obj, *args, **kwargs))
+            elapsed = time.time() - started
+            stats.record_compute(elapsed, entry.value)
+            soft_timeout = get_timeouts(cache_obj)[0]
+            if soft_timeout is not None:
+                entry.expires = time.time() + soft_timeout
+                entry.delta = elapsed
+            return entry
+
         @wraps(method)
         def wrapped_method(self, *args, **kwargs):
             force_reload = kwargs.pop('force_reload', False)
-            cache_obj = get_cache(cache_name) if cache_name else cache
-            cache_key = 'generic-%s-%s-%s' % (
-                self.__class__.__name__,
-                self.pk,
-                method.__name__,
-            )
-            for value in args:
-                if isinstance(value, (list, tuple)):
-                    value = ','.join(map(str, value))
-                cache_key += '-%s' % value
-            for key, value in kwargs.items():
-                if isinstance(value, (list, tuple)):
-                    value = ','.join(map(str, value))
-                cache_key += '-%s=%s' % (key, value)
+            cache_obj = get_cache_obj()
+            cache_key = get_key(self, args, kwargs)
             debug_info = [cache_key]
 
+            primed = self.__dict__.get('_cache_method_results', {})
+            entry = None
+            tier = None # where entry came from, if not the cache proper
             if force_reload:
-                result = method(self, *args, **kwargs)
-                cache_obj.set(cache_key, result)
+                primed.pop(cache_key, None)
                 debug_info.append('forced reload')
             else:
+                entry = primed.get(cache_key)
+                if entry is not None:
+                    tier = 'prefetched'
+                elif local_cache is not None:
+                    entry = local_cache.get(cache_key)
+                    if entry is not None:
+                        tier = 'local'
+                if tier is None:
+                    try:
+                        entry = cache_obj.get(cache_key)
+                    except Exception as e:
+                        logger.warning('Cache error: {0}'.format(e))
+                        stats.count('errors')
+            lease = False
+            if tier is None and isinstance(entry, CachedValue) and (
+                    entry.is_stale(early_recompute)):
+                lease = acquire_lease(cache_obj, cache_key, lease_timeout)
+                debug_info.append('stale')
+            if isinstance(entry, CachedValue) and not lease:
+                result = entry.value
+                debug_info.append('%s hit' % tier if tier else 'hit')
+                stats.count('hits', tier)
+            else:
+                if not force_reload:
+                    debug_info.append('miss')
+                stats.count('misses')
+                entry = compute(self, args, kwargs, cache_obj)
+                result = entry.value
                 try:
-                    result = cache_obj.get(cache_key)
+                    cache_obj.set(
+                        cache_key, entry, get_timeouts(cache_obj)[1])
                 except Exception as e:
                     logger.warning('Cache error: {0}'.format(e))
-                    result = None
-                if result is None:
-                    if cache_key not in cache_obj:
-                        debug_info.append('miss')
-                        result = method(self, *args, **kwargs)
-                        cache_obj.set(cache_key, result)
-                    else:
-                        pass # in the cache, but result is None
-                else:
-                    debug_info.append('hit')
+                    stats.count('errors')
+                if lease:
+                    release_lease(cache_obj, cache_key)
+            if local_cache is not None and tier != 'local':
+                local_cache.set(cache_key, entry)
             debug_info.append(result)
             if getattr(settings, 'GENERIC_CACHE_METHOD_DEBUG', False):
                 logger.debug(' -- '.join(map(str, debug_info)))
             return result
+
+        def prefetch(objects, *args, **kwargs):
+            """
+            Returns the method's results for each of `objects`, fetching them
+            with one get_many, computing only the misses (and stale results
+            it wins the lease for, as the method itself would) and storing
+            those with one set_many. The objects remember their results, so
+            calling the method on them again costs nothing.
+            """
+            objects = list(objects)
+            cache_obj = get_cache_obj()
+            if uses_generations(options):
+                alias = cache_name or 'default'
+                unknown = [
+                    obj for obj in objects if hasattr(obj, '_meta') and
+                    alias not in obj.__dict__.get('_cache_generations', {})
+                ]
+                for obj, generation in zip(
+                        unknown, fetch_generations(unknown, cache_name)):
+                    obj.__dict__.setdefault(
+                        '_cache_generations', {})[alias] = generation
+            keys = [get_key(obj, args, kwargs) for obj in objects]
+            entries = {}
+            if local_cache is not None:
+                for cache_key in keys:
+                    entry = local_cache.get(cache_key)
+                    if entry is not None:
+                        entries[cache_key] = entry
+                        stats.count('hits', 'local')
+            local_hits = set(entries)
+            try:
+                entries.update(cache_obj.get_many(
+                    [key for key in keys if key not in entries]))
+            except Exception as e:
+                logger.warning('Cache error: {0}'.format(e))
+                stats.count('errors')
+            computed = {}
+            leases = []
+            for obj, cache_key in zip(objects, keys):
+                entry = entries.get(cache_key)
+                if (isinstance(entry, CachedValue) and
+                        cache_key not in local_hits and
+                        cache_key not in computed and
+                        entry.is_stale(early_recompute) and
+                        acquire_lease(cache_obj, cache_key, lease_timeout)):
+                    leases.append(cache_key)
+                    entry = None
+                if not isinstance(entry, CachedValue):
+                    stats.count('misses')
+                    entries[cache_key] = computed[cache_key] = compute(
+                        obj, args, kwargs, cache_obj)
+                elif cache_key not in local_hits:
+                    stats.count('hits')
+                if local_cache is not None:
+                    local_cache.set(cache_key, entries[cache_key])
+                obj.__dict__.setdefault(
+                    '_cache_method_results', {})[cache_key] = entries[cache_key]
+            if computed:
+                try:
+                    cache_obj.set_many(computed, get_timeouts(cache_obj)[1])
+                except Exception as e:
+                    logger.warning('Cache error: {0}'.format(e))
+                    stats.count('errors')
+            for cache_key in leases:
+                release_lease(cache_obj, cache_key)
+            return [entries[cache_key].value for cache_key in keys]
+
+        def invalidate(obj, *args, **kwargs):
+            cache_key = get_key(obj, args, kwargs)
+            obj.__dict__.get('_cache_method_results', {}).pop(cache_key, None)
+            if local_cache is not None:
+                local_cache.delete(cache_key)
+            try:
+                get_cache_obj().delete(cache_key)
+            except Exception as e:
+                logger.warning('Cache error: {0}'.format(e))
+                stats.count('errors')
+
+        wrapped_method.invalidate = invalidate
+        wrapped_method.prefetch = prefetch
+        wrapped_method.local_cache = local_cache
+        wrapped_method.stats = stats
+        wrapped_method.cache_method_options = options
         return wrapped_method
     return inner
 
 
+def prefetch_cached_method(objects, method_name, *args, **kwargs):
+    """
+    Fetches the results of @cache_method method `method_name` (called with
+    `args` and `kwargs`) for all of `objects` in bulk, e.g. before rendering
+    a list which calls it on each; see cache_method's prefetch(). Returns the
+    results in order.
+    """
+    objects = list(objects)
+    by_method = OrderedDict()
+    for obj in objects:
+        by_method.setdefault(
+            getattr(obj.__class__, method_name), []).append(obj)
+    results = {}
+    for method, method_objects in by_method.items():
+        for obj, result in zip(method_objects, method.prefetch(
+                method_objects, *args, **kwargs)):
+            results[id(obj)] = result
+    return [results[id(obj)] for obj in objects]
+
+
 def cache_result_in_instance(method):
     """
     Caches the results of a method into its object instance using the passed
@@ -0,0 +1,47 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from ...mixins import LeafContentTypeMixin
+from ...utils.inheritance import backfill_leaf_field
+
+class Command(BaseCommand):
+    help = ('Fill in leaf_content_type for existing rows of '
+            'LeafContentTypeMixin models')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*', metavar='app_label.ModelName',
+            help='Base models to backfill (default: all of them)')
+        parser.add_argument(
+            '--all', action='store_true', dest='overwrite',
+            help='Recompute every row, not just those without a leaf type')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+            for model in models:
+                if not issubclass(model, LeafContentTypeMixin):
+                    raise CommandError(
+                        '%s does not use LeafContentTypeMixin' % (
+                            model.__name__))
+        else:
+            models = [model for model in apps.get_models() if (
+                issubclass(model, LeafContentTypeMixin) and
+                model._meta.get_field('leaf_content_type').model is model
+            )]
+        for model in models:
+            updated = backfill_leaf_field(
+                model._meta.get_field('leaf_content_type').model,
+                'leaf_content_type',
+                ContentType.objects.get_for_model,
+                empty=None,
+                overwrite=options['overwrite'],
+            )
+            if options.get('verbosity', 1) >= 1:
+                for leaf_model, count in updated:
+                    self.stdout.write(
+                        '%s: %d rows\n' % (leaf_model._meta.label, count))
@@ -0,0 +1,44 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from ...mixins import SubclassTypeMixin
+from ...utils.inheritance import backfill_leaf_field
+
+class Command(BaseCommand):
+    help = 'Fill in subclass_type for existing rows of SubclassTypeMixin models'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*', metavar='app_label.ModelName',
+            help='Base models to backfill (default: all of them)')
+        parser.add_argument(
+            '--all', action='store_true', dest='overwrite',
+            help='Recompute every row, not just those without a type')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+            for model in models:
+                if not issubclass(model, SubclassTypeMixin):
+                    raise CommandError(
+                        '%s does not use SubclassTypeMixin' % model.__name__)
+        else:
+            models = [model for model in apps.get_models() if (
+                issubclass(model, SubclassTypeMixin) and
+                model._meta.get_field('subclass_type').model is model
+            )]
+        for model in models:
+            updated = backfill_leaf_field(
+                model._meta.get_field('subclass_type').model,
+                'subclass_type',
+                lambda leaf_model: leaf_model._meta.label_lower,
+                empty='',
+                overwrite=options['overwrite'],
+            )
+            if options.get('verbosity', 1) >= 1:
+                for leaf_model, count in updated:
+                    self.stdout.write(
+                        '%s: %d rows\n' % (leaf_model._meta.label, count))
@@ -0,0 +1,81 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...utils.cache import (
+    collect_cache_method_stats,
+    merge_cache_method_stats,
+    summarise_cache_method_stats,
+)
+
+SORT_KEYS = {
+    'name': lambda name, stats, summary: name,
+    'calls': lambda name, stats, summary: -summary['calls'],
+    'misses': lambda name, stats, summary: -stats['misses'],
+    'hit-ratio': lambda name, stats, summary: (
+        summary['hit_ratio'] if summary['hit_ratio'] is not None else 2),
+    'compute': lambda name, stats, summary: -stats['compute_total'],
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Report cache_method hits, misses, errors, compute times and '
+        '(sampled) result sizes, as last flushed to the cache by each process'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sort', choices=sorted(SORT_KEYS), default='calls',
+            help='Order of methods (default: calls, most first)')
+        parser.add_argument(
+            '--json', action='store_true',
+            help='Output raw and summarised counters as JSON')
+
+    def handle(self, *args, **options):
+        processes = collect_cache_method_stats()
+        merged = merge_cache_method_stats(processes.values())
+        rows = sorted(
+            (
+                (name, stats, summarise_cache_method_stats(stats))
+                for name, stats in merged.items()
+            ),
+            key=lambda row: SORT_KEYS[options['sort']](*row),
+        )
+        if options['json']:
+            for name, stats, summary in rows:
+                if summary['compute_p95'] == float('inf'):
+                    summary['compute_p95'] = None # not valid JSON
+            self.stdout.write(json.dumps({
+                'processes': len(processes),
+                'methods': [
+                    dict(stats, name=name, **summary)
+                    for name, stats, summary in rows
+                ],
+            }, indent=2))
+            return
+        self.stdout.write('%d process(es) reporting' % len(processes))
+        if not rows:
+            return
+        self.stdout.write('%-60s %8s %6s %8s %6s %9s %9s %9s' % (
+            'method', 'calls', 'hit%', 'in-proc', 'errors',
+            'mean ms', 'p95 ms', 'mean B'))
+        for name, stats, summary in rows:
+            self.stdout.write('%-60s %8d %6s %8d %6d %9s %9s %9s' % (
+                name,
+                summary['calls'],
+                format_value(summary['hit_ratio'], 100, '%.1f'),
+                stats['local_hits'] + stats['prefetched_hits'],
+                stats['errors'],
+                format_value(summary['compute_mean'], 1000, '%.1f'),
+                format_value(summary['compute_p95'], 1000, '<%g'),
+                format_value(summary['payload_mean'], 1, '%d'),
+            ))
+
+
+def format_value(value, scale, format):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return 'slow'
+    return format % (value * scale)
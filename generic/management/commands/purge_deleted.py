@@ -0,0 +1,171 @@
+import datetime
+import json
+import time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models.deletion import Collector, ProtectedError
+
+from ...models.delible import Delible, DelibleArchive
+
+class Command(BaseCommand):
+    help = 'Hard-delete (or archive) Delible rows deleted some days ago'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*', metavar='app_label.ModelName',
+            help='Delible models to purge (default: all of them)')
+        parser.add_argument(
+            '--days', type=int, default=30,
+            help='Purge rows deleted more than this many days ago '
+                 '(default: 30). Rows with live (not "deleted") objects '
+                 'cascading from them are skipped.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows to purge per transaction (default: 1000)')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between chunks, to spare the database')
+        parser.add_argument(
+            '--archive', action='store_true',
+            help='Copy rows, and any rows cascading from them, to '
+                 'DelibleArchive before deleting them')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many rows would be purged')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+            for model in models:
+                if not issubclass(model, Delible):
+                    raise CommandError(
+                        '%s is not Delible' % model.__name__)
+        else:
+            models = [model for model in apps.get_models() if (
+                issubclass(model, Delible) and
+                model._meta.get_field('deleted').model is model
+            )]
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            days=options['days'])
+        for model in models:
+            queryset = model._base_manager.filter(
+                deleted__lt=cutoff).order_by('pk')
+            purged, skipped = self.purge(queryset, **options)
+            if options.get('verbosity', 1) >= 1:
+                self.stdout.write('%s: %d rows %s%s%s\n' % (
+                    model._meta.label,
+                    purged,
+                    'would be ' if options['dry_run'] else '',
+                    'archived' if options['archive'] else 'purged',
+                    ', %d skipped (live or protected objects depend on them)'
+                    % skipped
+                    if skipped else '',
+                ))
+
+    def purge(self, queryset, chunk_size, sleep, archive, dry_run,
+              **options):
+        """
+        Purges `queryset` in primary key order, a chunk at a time, skipping
+        rows which live objects cascade from or protected objects refer to.
+        Returns the number of rows purged and skipped.
+        """
+        using = router.db_for_write(queryset.model)
+        purged = skipped = 0
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(
+                pk__gt=last_pk)
+            pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            if purged and sleep:
+                time.sleep(sleep)
+            with transaction.atomic(using=using):
+                rows = list(queryset.filter(pk__in=pks))
+                collector = collect(rows, using)
+                if not is_purgeable(collector):
+                    # find the culprits; a rare case, hence row by row
+                    kept = [
+                        row for row in rows
+                        if is_purgeable(collect([row], using))
+                    ]
+                    skipped += len(rows) - len(kept)
+                    rows = kept
+                    collector = collect(rows, using)
+                if rows and not dry_run:
+                    if archive:
+                        self.archive(collector)
+                    collector.delete()
+            purged += len(rows)
+            last_pk = pks[-1]
+        return purged, skipped
+
+    def archive(self, collector):
+        """
+        Copies everything `collector` is to delete to DelibleArchive; rows
+        of models which aren't Delible are stamped as deleted now.
+        """
+        now = datetime.datetime.now()
+        archives = []
+        for model, objects in iter_collected(collector):
+            content_type = ContentType.objects.get_for_model(model)
+            serialized = json.loads(serializers.serialize('json', objects))
+            archives.extend(
+                DelibleArchive(
+                    content_type=content_type,
+                    object_pk=str(obj.pk),
+                    data=json.dumps(data['fields']),
+                    deleted=getattr(obj, 'deleted', None) or now,
+                    deleted_by_id=getattr(obj, 'deleted_by_id', None),
+                )
+                for obj, data in zip(objects, serialized)
+            )
+        DelibleArchive.objects.bulk_create(archives)
+
+
+def collect(rows, using):
+    """
+    Returns a Collector of `rows` and everything cascading from them, or None
+    if PROTECT foreign keys refer to any of that.
+    """
+    collector = Collector(using=using)
+    try:
+        collector.collect(rows)
+    except ProtectedError:
+        return None
+    return collector
+
+
+def is_purgeable(collector):
+    return collector is not None and not has_live_objects(collector)
+
+
+def iter_collected(collector):
+    """ Yields (model, objects) for everything `collector` is to delete """
+    for model, objects in collector.data.items():
+        yield model, list(objects)
+    for queryset in collector.fast_deletes:
+        objects = list(queryset)
+        if objects:
+            yield queryset.model, objects
+
+
+def has_live_objects(collector):
+    """ Whether `collector` is to delete any live (not "deleted") objects """
+    return any(
+        obj.deleted is None
+        for model, objects in collector.data.items()
+        if issubclass(model, Delible)
+        for obj in objects
+    ) or any(
+        queryset.filter(deleted=None).exists()
+        for queryset in collector.fast_deletes
+        if issubclass(queryset.model, Delible)
+    )
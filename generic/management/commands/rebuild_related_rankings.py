@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from ...models import (
+    Relatable,
+    RelatedItemRank,
+    get_related_ranking_size,
+    update_related_rankings,
+)
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed top related items of every Relatable'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', type=int, default=get_related_ranking_size(),
+            help='Number of related items to rank per item '
+                 '(default: settings.GENERIC_RELATED_RANKING_SIZE)')
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of items to rank per transaction')
+
+    def handle(self, *args, **options):
+        if not options['size']:
+            raise CommandError(
+                'Set --size or settings.GENERIC_RELATED_RANKING_SIZE')
+        # replaced chunk by chunk, so that rankings never go missing meanwhile
+        last_pk = None
+        ranked = 0
+        while True:
+            items = Relatable.objects.order_by('pk')
+            if last_pk is not None:
+                items = items.filter(pk__gt=last_pk)
+            pks = list(items.values_list('pk', flat=True)[
+                :options['chunk_size']])
+            if not pks:
+                break
+            update_related_rankings(pks, size=options['size'])
+            ranked += len(pks)
+            last_pk = pks[-1]
+        existing = Relatable.objects.values('pk')
+        RelatedItemRank.objects.filter(
+            ~Q(item__in=existing) | ~Q(related_item__in=existing)).delete()
+        if options.get('verbosity', 1) >= 1:
+            self.stdout.write('Ranked related items for %d items\n' % ranked)
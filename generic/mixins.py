@@ -1,15 +1,33 @@
+from collections import defaultdict
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.encoding import force_text
 
+from .utils.inheritance import registry
+
 class Inheritable(object):
     def get_leaf_object(self):
         """Returns the model instance object as instance of the outermost leaf class,
         by searching through its related descriptors to find the right model."""
-        for obj in self._meta.get_all_related_objects():
-            if obj.model != self.__class__ and obj.field.rel.parent_link:
+        try:
+            return self.__dict__['_leaf_object'] # see get_leaf_objects()
+        except KeyError:
+            pass
+        leaf_model = get_stored_leaf_model(self)
+        if leaf_model is self.__class__:
+            return self
+        if leaf_model is not None:
+            try:
+                return leaf_model._base_manager.get(pk=self.pk)
+            except leaf_model.DoesNotExist:
+                pass # stale; search for it instead
+        for rel in self._meta.related_objects:
+            if rel.related_model != self.__class__ and rel.parent_link:
                 try:
-                    return getattr(self, obj.get_accessor_name()).get_leaf_object()
-                except obj.model.DoesNotExist:
+                    return getattr(self, rel.get_accessor_name()).get_leaf_object()
+                except rel.related_model.DoesNotExist:
                     pass
         return self
 
@@ -26,6 +44,163 @@ class Inheritable(object):
         return '%s object' % self.__class__.__name__
 
 
+def get_stored_leaf_model(obj):
+    """
+    Returns the leaf model recorded by LeafContentTypeMixin for `obj`, if it
+    is a subclass of obj's class, otherwise None.
+    """
+    content_type_id = getattr(obj, 'leaf_content_type_id', None)
+    if content_type_id:
+        leaf_model = ContentType.objects.get_for_id(
+            content_type_id).model_class()
+        if leaf_model and issubclass(leaf_model, obj.__class__):
+            return leaf_model
+    return None
+
+
+def get_leaf_objects(objects):
+    """
+    Returns Inheritable model instances as instances of their leaf classes,
+    in the same order. Uses one query per leaf class present for objects with
+    a stored leaf content type (see LeafContentTypeMixin), otherwise one query
+    per subclass (deepest first), rather than get_leaf_object()'s queries per
+    level per object. All instances involved remember their leaf, so e.g.
+    __str__ won't query again.
+    """
+    objects = list(objects)
+    pks_by_model = defaultdict(set)
+    pks_by_leaf_model = defaultdict(set)
+    for obj in objects:
+        if '_leaf_object' not in obj.__dict__:
+            model = obj._meta.concrete_model
+            leaf_model = get_stored_leaf_model(obj)
+            if leaf_model is None:
+                pks_by_model[model].add(obj.pk)
+            elif leaf_model is not obj.__class__:
+                pks_by_leaf_model[(model, leaf_model)].add(obj.pk)
+    leaves = {}
+    for (model, leaf_model), pks in pks_by_leaf_model.items():
+        found = leaf_model._base_manager.in_bulk(list(pks))
+        for pk, leaf in found.items():
+            leaves[(model, pk)] = leaf
+        pks_by_model[model].update(pks.difference(found)) # stale
+    for model, pks in pks_by_model.items():
+        for subclass in reversed(registry.get_descendants(model)):
+            if not pks:
+                break
+            found = subclass._base_manager.in_bulk(list(pks))
+            for pk, leaf in found.items():
+                leaves[(model, pk)] = leaf
+            pks.difference_update(found)
+    results = []
+    for obj in objects:
+        leaf = obj.__dict__.get('_leaf_object') or leaves.get(
+            (obj._meta.concrete_model, obj.pk), obj)
+        obj._leaf_object = leaf._leaf_object = leaf
+        results.append(leaf)
+    return results
+
+
+class InheritableQuerySet(models.QuerySet):
+    def leaves(self):
+        """ Evaluates as leaf instances; see get_leaf_objects() """
+        return get_leaf_objects(self)
+
+
+def get_auto_now_values(model):
+    """
+    Returns {field name: current value} for `model`'s auto_now fields, as
+    save() would set them, i.e. via each field's pre_save().
+    """
+    # pre_save() just sets the attribute, so an uninitialised instance will do
+    instance = model.__new__(model)
+    return dict(
+        (field.name, field.pre_save(instance, False))
+        for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False)
+    )
+
+
+def with_auto_now(model, values):
+    """ Returns update() `values` plus any auto_now fields not in them """
+    stamped = get_auto_now_values(model)
+    stamped.update(values)
+    return stamped
+
+
+class AutoNowQuerySet(models.QuerySet):
+    """
+    QuerySet whose update() and bulk_update() also set auto_now fields (e.g.
+    HousekeepingMixin.date_modified), in the same statement, as save() would.
+    """
+    def update(self, **kwargs):
+        return super(AutoNowQuerySet, self).update(
+            **with_auto_now(self.model, kwargs))
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        if not fields: # let Django complain
+            return super(AutoNowQuerySet, self).bulk_update(
+                objs, fields, batch_size=batch_size)
+        auto_now = get_auto_now_values(self.model)
+        for obj in objs:
+            for name, value in auto_now.items():
+                setattr(obj, name, value)
+        fields = list(fields) + [
+            name for name in auto_now if name not in fields]
+        return super(AutoNowQuerySet, self).bulk_update(
+            objs, fields, batch_size=batch_size)
+    bulk_update.alters_data = True
+
+
+def changed_since(queryset, cursor=None):
+    """
+    Returns HousekeepingMixin objects in `queryset` modified after `cursor`
+    (a (date_modified, pk) pair, e.g. from get_changed_since_cursor()), in
+    modification order, for keyset pagination through changes. Slice the
+    result as required; each slice costs one indexed range query (see
+    ChangedSinceIndex) however far through the table it is.
+    """
+    queryset = queryset.order_by('date_modified', 'pk')
+    if cursor is not None:
+        date_modified, pk = cursor
+        # the redundant >= lets the database seek rather than scan the index
+        queryset = queryset.filter(
+            models.Q(date_modified__gt=date_modified) |
+            models.Q(date_modified=date_modified, pk__gt=pk),
+            date_modified__gte=date_modified,
+        )
+    return queryset
+
+
+def get_changed_since_cursor(obj):
+    """ Returns the changed_since() cursor for objects changed after `obj` """
+    return (obj.date_modified, obj.pk)
+
+
+class HousekeepingQuerySet(AutoNowQuerySet):
+    def changed_since(self, cursor=None):
+        """ See changed_since() """
+        return changed_since(self, cursor)
+
+
+class ChangedSinceIndex(models.Index):
+    """
+    Index matching changed_since()'s ordering and filtering, e.g.
+
+        class Meta:
+            indexes = [ChangedSinceIndex()]
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('fields', ['date_modified', 'id'])
+        super(ChangedSinceIndex, self).__init__(**kwargs)
+
+    def deconstruct(self):
+        # migrations needn't depend on this class
+        path, args, kwargs = super(ChangedSinceIndex, self).deconstruct()
+        return 'django.db.models.Index', args, kwargs
+
+
 class HousekeepingMixin(models.Model):
     """Abstract mixin class to collect creation and update timestamps."""
     date_created = models.DateTimeField(auto_now_add=True)
@@ -33,5 +208,67 @@ class HousekeepingMixin(models.Model):
 
     deleted = models.BooleanField(default=False)
 
+    objects = HousekeepingQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+class SubclassTypeMixin(models.Model):
+    """
+    Abstract mixin for multi-table inheritance base models which stores the
+    concrete class of each row in an indexed column, so that filtering and
+    counting by type (e.g. via SubclassFilter) needn't join child tables.
+
+    Set automatically on save; use the `backfill_subclass_type` management
+    command to fill it in for existing rows.
+    """
+    subclass_type = models.CharField(
+        max_length=100, blank=True, db_index=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        model = self._meta.concrete_model
+        try:
+            stored_model = apps.get_model(self.subclass_type)
+        except (LookupError, ValueError):
+            stored_model = None
+        # don't let a save via a less specific class downgrade the type
+        if stored_model is None or issubclass(model, stored_model):
+            self.subclass_type = model._meta.label_lower
+        super(SubclassTypeMixin, self).save(*args, **kwargs)
+
+
+class LeafContentTypeMixin(models.Model):
+    """
+    Abstract mixin for Inheritable base models which stores the content type
+    of each row's leaf class, so that get_leaf_object() can fetch the right
+    subclass directly with a single primary key lookup rather than probing
+    every child table.
+
+    Set automatically on save; use the `backfill_leaf_content_type`
+    management command to fill it in for existing rows.
+    """
+    leaf_content_type = models.ForeignKey(
+        'contenttypes.ContentType',
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='+',
+        editable=False,
+    )
+
     class Meta:
         abstract = True
+
+    def save(self, *args, **kwargs):
+        model = self._meta.concrete_model
+        stored_model = None
+        if self.leaf_content_type_id:
+            stored_model = ContentType.objects.get_for_id(
+                self.leaf_content_type_id).model_class()
+        # don't let a save via a less specific class downgrade the type
+        if stored_model is None or issubclass(model, stored_model):
+            self.leaf_content_type = ContentType.objects.get_for_model(model)
+        super(LeafContentTypeMixin, self).save(*args, **kwargs)
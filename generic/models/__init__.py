@@ -1,10 +1,296 @@
-from django.db import models
+import sqlite3
+
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from ..mixins import Inheritable, InheritableQuerySet
+from .delible import DelibleArchive
+
+
+def supports_recursive_cte(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 8, 3)
+    if connection.vendor == 'mysql':
+        return connection.mysql_version >= (8,)
+    return False
 
-from ..mixins import Inheritable
 
 class Relatable(models.Model, Inheritable):
     """
     NON-abstract model mixin that encapsulates a many-to-many field to itself.
     """
     related_items = models.ManyToManyField('Relatable', blank=True,
-                       symmetrical=True, help_text="contents related to this")    
+                       symmetrical=True, help_text="contents related to this")
+
+    objects = InheritableQuerySet.as_manager()
+
+    def get_related_distances(self, depth=2, limit=None):
+        """
+        Returns (pk, distance) pairs for items up to `depth` hops away via
+        related_items, nearest first (then by pk), optionally only the first
+        `limit` of them.
+
+        Uses a single recursive query where the database supports it, or else
+        one query per hop.
+        """
+        connection = connections[router.db_for_read(Relatable)]
+        if supports_recursive_cte(connection):
+            return self._get_related_distances_recursive(
+                connection, depth, limit)
+        return self._get_related_distances_by_hop(depth, limit)
+
+    def get_top_related(self, limit=None):
+        """
+        Returns the precomputed top related items (see RelatedItemRank), best
+        first, with one indexed query.
+        """
+        ranks = RelatedItemRank.objects.filter(item=self).select_related(
+            'related_item').order_by('rank')
+        if limit is not None:
+            ranks = ranks[:limit]
+        return [rank.related_item for rank in ranks]
+
+    def get_related_neighbourhood(self, depth=2, limit=None):
+        """
+        Returns (item, distance) pairs as per get_related_distances(), using
+        one further query to fetch the items.
+        """
+        distances = self.get_related_distances(depth=depth, limit=limit)
+        items = Relatable.objects.in_bulk([pk for pk, distance in distances])
+        return [
+            (items[pk], distance) for pk, distance in distances if pk in items]
+
+    @classmethod
+    def relate_pairs(cls, pairs, batch_size=None):
+        """
+        Relates the items of each (item, item) pair (instances or pks) to each
+        other, like related_items.add() but writing both directions of every
+        pair with a single bulk insert, skipping existing relations.
+
+        Doesn't send m2m_changed signals.
+        """
+        pairs = get_relatable_pk_pairs(pairs)
+        through = Relatable.related_items.through
+        field = Relatable._meta.get_field('related_items')
+        from_id = field.m2m_column_name()
+        to_id = field.m2m_reverse_name()
+        rows = set(pairs).union((b, a) for a, b in pairs)
+        through.objects.bulk_create(
+            [through(**{from_id: a, to_id: b}) for a, b in sorted(rows)],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        schedule_related_rankings_update(
+            set(pk for pair in pairs for pk in pair),
+            using=router.db_for_write(through),
+        )
+
+    @classmethod
+    def unrelate_pairs(cls, pairs, batch_size=None):
+        """
+        Removes relations between the items of each (item, item) pair
+        (instances or pks), in both directions, with a single DELETE (or one
+        per `batch_size` pairs, by default as many as the database allows).
+
+        Doesn't send m2m_changed signals.
+        """
+        pairs = get_relatable_pk_pairs(pairs)
+        through = Relatable.related_items.through
+        field = Relatable._meta.get_field('related_items')
+        from_name = field.m2m_field_name()
+        to_name = field.m2m_reverse_field_name()
+        using = router.db_for_write(through)
+        if batch_size is None:
+            batch_size = connections[using].ops.bulk_batch_size(
+                [from_name, to_name] * 2, pairs)
+        batch_size = max(batch_size, 1)
+        for start in range(0, len(pairs), batch_size):
+            condition = models.Q()
+            for a, b in pairs[start:start + batch_size]:
+                condition |= models.Q(**{from_name: a, to_name: b})
+                condition |= models.Q(**{from_name: b, to_name: a})
+            if not condition: # an empty filter would delete every relation
+                continue
+            # nothing cascades from through rows; skip the Collector, which
+            # won't fast-delete models with m2m_changed receivers
+            through.objects.using(using).filter(condition)._raw_delete(using)
+        schedule_related_rankings_update(
+            set(pk for pair in pairs for pk in pair), using=using)
+
+    def _get_related_distances_recursive(self, connection, depth, limit):
+        field = Relatable._meta.get_field('related_items')
+        qn = connection.ops.quote_name
+        sql = (
+            'WITH RECURSIVE neighbourhood (item_id, distance) AS ('
+            ' SELECT {to_id}, 1 FROM {table} WHERE {from_id} = %s'
+            ' UNION'
+            ' SELECT {table}.{to_id}, neighbourhood.distance + 1'
+            ' FROM {table} INNER JOIN neighbourhood'
+            ' ON {table}.{from_id} = neighbourhood.item_id'
+            ' WHERE neighbourhood.distance < %s'
+            ') SELECT item_id, MIN(distance) FROM neighbourhood'
+            ' WHERE item_id <> %s GROUP BY item_id'
+            ' ORDER BY MIN(distance), item_id'
+        ).format(
+            table=qn(field.m2m_db_table()),
+            from_id=qn(field.m2m_column_name()),
+            to_id=qn(field.m2m_reverse_name()),
+        )
+        params = [self.pk, depth, self.pk]
+        if limit is not None:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def _get_related_distances_by_hop(self, depth, limit):
+        through = Relatable.related_items.through
+        field = Relatable._meta.get_field('related_items')
+        from_name = field.m2m_field_name()
+        to_name = field.m2m_reverse_field_name()
+        distances = []
+        seen = set([self.pk])
+        frontier = [self.pk]
+        for distance in range(1, depth + 1):
+            if not frontier or (limit is not None and len(distances) >= limit):
+                break
+            frontier = sorted(set(
+                through.objects.filter(
+                    **{'%s__in' % from_name: frontier}
+                ).values_list('%s_id' % to_name, flat=True)
+            ).difference(seen))
+            seen.update(frontier)
+            distances.extend((pk, distance) for pk in frontier)
+        return distances if limit is None else distances[:limit]
+
+
+def get_relatable_pk_pairs(pairs):
+    """ Returns sorted, unique (lower pk, higher pk) pairs """
+    pk_pairs = set()
+    for a, b in pairs:
+        a, b = getattr(a, 'pk', a), getattr(b, 'pk', b)
+        pk_pairs.add((min(a, b), max(a, b)))
+    return sorted(pk_pairs)
+
+
+class RelatedItemRank(models.Model):
+    """
+    Materialised "top N related items" for Relatable objects: their directly
+    related items, ranked by the number of related items they share (then
+    most recent first).
+
+    Kept up to date from related_items changes when
+    settings.GENERIC_RELATED_RANKING_SIZE (N) is set; rebuild it in full with
+    the `rebuild_related_rankings` management command.
+    """
+    item = models.ForeignKey(
+        Relatable, on_delete=models.CASCADE, related_name='+')
+    related_item = models.ForeignKey(
+        Relatable, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (('item', 'rank'),)
+
+
+def get_related_ranking_size():
+    return getattr(settings, 'GENERIC_RELATED_RANKING_SIZE', 0)
+
+
+def rank_related_items(pk, size):
+    """ Returns the top `size` (related item pk, score) pairs for item `pk` """
+    field = Relatable._meta.get_field('related_items')
+    connection = connections[router.db_for_read(Relatable)]
+    qn = connection.ops.quote_name
+    sql = (
+        'SELECT candidate.{to_id}, COUNT(shared.{to_id})'
+        ' FROM {table} candidate'
+        ' LEFT OUTER JOIN {table} neighbour'
+        ' ON neighbour.{from_id} = candidate.{to_id}'
+        ' LEFT OUTER JOIN {table} shared'
+        ' ON shared.{from_id} = candidate.{from_id}'
+        ' AND shared.{to_id} = neighbour.{to_id}'
+        ' WHERE candidate.{from_id} = %s AND candidate.{to_id} <> %s'
+        ' GROUP BY candidate.{to_id}'
+        ' ORDER BY COUNT(shared.{to_id}) DESC, candidate.{to_id} DESC'
+        ' LIMIT %s'
+    ).format(
+        table=qn(field.m2m_db_table()),
+        from_id=qn(field.m2m_column_name()),
+        to_id=qn(field.m2m_reverse_name()),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [pk, pk, size])
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def update_related_rankings(pks, size=None):
+    """
+    Recomputes RelatedItemRank rows for the Relatable items `pks`, locking
+    the items (in pk order, so as not to deadlock) so that concurrent updates
+    of overlapping items take turns rather than colliding on (item, rank).
+    """
+    size = size or get_related_ranking_size()
+    using = router.db_for_write(RelatedItemRank)
+    with transaction.atomic(using=using):
+        pks = list(
+            Relatable._base_manager.using(using).select_for_update().filter(
+                pk__in=list(pks)).order_by('pk').values_list('pk', flat=True))
+        ranks = []
+        for pk in pks:
+            for rank, (related_pk, score) in enumerate(
+                    rank_related_items(pk, size), 1):
+                ranks.append(RelatedItemRank(
+                    item_id=pk, related_item_id=related_pk, rank=rank,
+                    score=score))
+        RelatedItemRank.objects.filter(item__in=pks).delete()
+        RelatedItemRank.objects.bulk_create(ranks)
+
+
+def get_ranking_affected_pks(pks):
+    """
+    Returns the items whose rankings depend on relations of items `pks`, i.e.
+    those items and their related items.
+    """
+    field = Relatable._meta.get_field('related_items')
+    affected = set(pks)
+    affected.update(
+        Relatable.related_items.through.objects.filter(**{
+            '%s__in' % field.m2m_field_name(): affected,
+        }).values_list('%s_id' % field.m2m_reverse_field_name(), flat=True)
+    )
+    return affected
+
+
+def schedule_related_rankings_update(pks, using):
+    """
+    Re-ranks the items affected by relation changes of items `pks` once the
+    current transaction commits, if ranking is enabled.
+    """
+    if pks and get_related_ranking_size():
+        transaction.on_commit(
+            lambda: update_related_rankings(get_ranking_affected_pks(pks)),
+            using=using,
+        )
+
+
+@receiver(m2m_changed, sender=Relatable.related_items.through)
+def update_related_rankings_on_change(sender, instance, action, pk_set, using,
+                                      **kwargs):
+    if not get_related_ranking_size():
+        return
+    if action == 'pre_clear':
+        instance._cleared_related_pks = set(
+            instance.related_items.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_related_pks', set())
+        # on commit, since symmetrical mirror rows are written after the signal
+        schedule_related_rankings_update(
+            set([instance.pk]) | set(pk_set), using=using)
@@ -1,13 +1,89 @@
 import datetime
+from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core import checks
+from django.db import models, router, transaction
+
+from ..mixins import AutoNowQuerySet, with_auto_now
 
 user_model = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
 
-class DelibleManager(models.Manager):
+LIVE = models.Q(deleted=None)
+
+
+class DelibleIndex(models.Index):
+    """
+    Partial index over live (not "deleted") rows only, to match the
+    deleted=None filter which DelibleManager adds to every query; e.g.
+
+        class Meta:
+            indexes = [DelibleIndex(fields=['category', '-published'])]
+
+    Unlike other conditional indexes, these are named automatically. Backends
+    without partial index support (MySQL, Oracle) create a plain index.
+    """
+    suffix = 'liv'
+
+    def __init__(self, **kwargs):
+        condition = kwargs.pop('condition', LIVE)
+        super(DelibleIndex, self).__init__(**kwargs)
+        self.condition = condition # set late, to permit automatic names
+
+    def deconstruct(self):
+        # migrations needn't depend on this class
+        path, args, kwargs = super(DelibleIndex, self).deconstruct()
+        return 'django.db.models.Index', args, kwargs
+
+
+def is_live_index(index):
+    """ Whether `index` is restricted to live rows, as per DelibleIndex """
+    return index.condition in (LIVE, models.Q(deleted__isnull=True))
+
+
+class DelibleQuerySet(AutoNowQuerySet):
+    def delete(self, request=None, cascade=None):
+        """
+        "Deletes" the objects not already deleted with a single UPDATE,
+        recording the request's user. Returns the number of objects deleted.
+
+        If `cascade` (default: the model's soft_delete_cascade), Delible
+        objects related to them via CASCADE foreign keys are "deleted" too;
+        see cascade_soft_delete().
+        """
+        deleted = datetime.datetime.now()
+        deleted_by = request.user if request is not None else None
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            count = self.filter(deleted=None).update(
+                deleted=deleted, deleted_by=deleted_by)
+            if count and get_cascade(self.model, cascade):
+                cascade_soft_delete(self.model, deleted, deleted_by)
+        return count
+    delete.queryset_only = True
+
+    def undelete(self, cascade=None):
+        """
+        Undeletes the deleted objects with a single UPDATE, and if `cascade`
+        (default: the model's soft_delete_cascade) the related objects deleted
+        along with them; see cascade_undelete().
+        """
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            objects = self.exclude(deleted=None)
+            if get_cascade(self.model, cascade):
+                cascade_undelete(
+                    self.model, list(objects.values_list('pk', flat=True)))
+            return objects.update(deleted=None, deleted_by=None)
+    undelete.queryset_only = True
+
+    def hard_delete(self):
+        """ Really deletes the objects (and anything cascading from them) """
+        return super(DelibleQuerySet, self).delete()
+    hard_delete.queryset_only = True
+
+
+class DelibleManager(models.Manager.from_queryset(DelibleQuerySet)):
     """
     Excludes "deleted" objects from standard query sets. Use with caution.
     """
@@ -39,19 +115,206 @@ class Delible(models.Model):
     )
 
     is_delible = True
+    # whether deleting also "deletes" Delible objects with CASCADE foreign
+    # keys to this one, and undeleting restores them (see cascade_soft_delete)
+    soft_delete_cascade = False
 
     class Meta:
         abstract = True
 
+    @classmethod
+    def check(cls, **kwargs):
+        errors = super(Delible, cls).check(**kwargs)
+        errors.extend(cls._check_live_indexes())
+        return errors
+
+    @classmethod
+    def _check_live_indexes(cls):
+        """
+        Warns about indexed columns of live-filtered models lacking an index
+        restricted to live rows (see DelibleIndex).
+        """
+        if not isinstance(cls._default_manager, DelibleManager):
+            return []
+        if cls._meta.abstract or cls._meta.proxy or not cls._meta.managed:
+            return []
+        indexed = [
+            (field.name,) for field in cls._meta.local_fields
+            if field.db_index and not field.primary_key
+            and field.name not in ('deleted', 'deleted_by')
+        ]
+        indexed.extend(tuple(fields) for fields in cls._meta.index_together)
+        live = []
+        for index in cls._meta.indexes:
+            fields = tuple(
+                field_name for field_name, order in index.fields_orders)
+            (live if is_live_index(index) else indexed).append(fields)
+        missing = [
+            fields for fields in indexed
+            if not any(other[:len(fields)] == fields for other in live)
+        ]
+        if not missing:
+            return []
+        return [
+            checks.Warning(
+                '%s is filtered by deleted=None but has no index on %s '
+                'restricted to live rows.' % (
+                    cls._meta.label,
+                    ', '.join('(%s)' % ', '.join(f) for f in missing),
+                ),
+                hint='Add DelibleIndex(fields=[...]) to Meta.indexes.',
+                obj=cls,
+                id='generic.W001',
+            )
+        ]
+
     def is_deleted(self):
         return self.deleted is not None
 
-    def delete(self, using=None, request=None):
-        self.deleted = datetime.datetime.now()
-        self.deleted_by = request.user
-        self.save()
+    def delete(self, using=None, request=None, cascade=None):
+        with transaction.atomic(using=using or router.db_for_write(
+                self.__class__, instance=self)):
+            self.deleted = datetime.datetime.now()
+            self.deleted_by = request.user if request is not None else None
+            self.save(using=using)
+            if get_cascade(self.__class__, cascade):
+                cascade_soft_delete(
+                    self._meta.concrete_model, self.deleted, self.deleted_by)
+
+    def undelete(self, cascade=None):
+        with transaction.atomic(using=router.db_for_write(
+                self.__class__, instance=self)):
+            if self.deleted is not None and get_cascade(
+                    self.__class__, cascade):
+                cascade_undelete(self._meta.concrete_model, [self.pk])
+            self.deleted = None
+            self.deleted_by = None
+            self.save()
+
+
+def get_cascade(model, cascade=None):
+    return model.soft_delete_cascade if cascade is None else cascade
+
+
+def get_cascading_relations(model):
+    """
+    Returns relations to `model` from Delible models via CASCADE foreign keys
+    (excluding multi-table inheritance links, which share the parent's flag).
+    """
+    return [
+        rel for rel in model._meta.related_objects
+        if not rel.many_to_many
+        and rel.on_delete is models.CASCADE
+        and not getattr(rel, 'parent_link', False)
+        and issubclass(rel.related_model, Delible)
+    ]
+
+
+def cascade_soft_delete(model, deleted, deleted_by=None):
+    """
+    "Deletes" live Delible objects with CASCADE foreign keys to objects of
+    `model` deleted at `deleted`, and so on down the object graph, stamping
+    them the same way. Uses one UPDATE per related model (per level).
+    """
+    for rel in get_cascading_relations(model):
+        parents = model._base_manager.filter(deleted=deleted)
+        count = rel.related_model._base_manager.filter(**{
+            'deleted': None,
+            '%s__in' % rel.field.name: parents.values(
+                rel.field.target_field.attname),
+        }).update(**with_auto_now(rel.related_model, {
+            'deleted': deleted,
+            'deleted_by': deleted_by,
+        }))
+        if count:
+            cascade_soft_delete(rel.related_model, deleted, deleted_by)
+
+
+def get_soft_delete_cascade(model, objs):
+    """
+    Returns the live Delible objects which "deleting" `objs` of `model` would
+    "delete" too (see cascade_soft_delete), as a dict mapping each object to
+    those with CASCADE foreign keys to it. Uses one query per related model
+    (per level).
+    """
+    children = defaultdict(list)
+    seen = set((model, obj.pk) for obj in objs)
+    level = [(model, list(objs))]
+    while level:
+        next_level = []
+        for parent_model, parents in level:
+            for rel in get_cascading_relations(parent_model):
+                related = rel.related_model
+                by_value = dict(
+                    (getattr(parent, rel.field.target_field.attname), parent)
+                    for parent in parents
+                )
+                found = []
+                for child in related._base_manager.filter(**{
+                    'deleted': None,
+                    '%s__in' % rel.field.attname: list(by_value),
+                }):
+                    if (related, child.pk) in seen:
+                        continue
+                    seen.add((related, child.pk))
+                    children[by_value[getattr(child, rel.field.attname)]
+                             ].append(child)
+                    found.append(child)
+                if found:
+                    next_level.append((related, found))
+        level = next_level
+    return children
+
+
+def cascade_undelete(model, pks, seen=None):
+    """
+    Undeletes Delible objects with CASCADE foreign keys to objects `pks` of
+    `model` which were deleted along with them (i.e. at the same time), and
+    so on down the object graph. Deepest objects are undeleted first, since
+    matching relies on parents still being marked deleted.
+    """
+    if seen is None:
+        seen = {}
+    seen.setdefault(model, set()).update(pks)
+    for rel in get_cascading_relations(model):
+        related = rel.related_model
+        children = related._base_manager.filter(**{
+            '%s__pk__in' % rel.field.name: pks,
+            'deleted': models.F('%s__deleted' % rel.field.name),
+        })
+        child_pks = [
+            pk for pk in children.values_list('pk', flat=True)
+            if pk not in seen.get(related, ())
+        ]
+        if child_pks:
+            cascade_undelete(related, child_pks, seen)
+            related._base_manager.filter(pk__in=child_pks).update(
+                **with_auto_now(related, {
+                    'deleted': None,
+                    'deleted_by': None,
+                }))
+
+
+class DelibleArchive(models.Model):
+    """
+    Serialized copy of a Delible object purged by the `purge_deleted`
+    management command with --archive.
+    """
+    content_type = models.ForeignKey(
+        ContentType, on_delete=models.CASCADE, related_name='+')
+    object_pk = models.CharField(max_length=255)
+    data = models.TextField()
+    deleted = models.DateTimeField()
+    deleted_by = models.ForeignKey(
+        user_model,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='+',
+    )
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (('content_type', 'object_pk'),)
 
-    def undelete(self):
-        self.deleted = None
-        self.deleted_by = None
-        self.save()
+    def __str__(self):
+        return '%s %s' % (self.content_type, self.object_pk)
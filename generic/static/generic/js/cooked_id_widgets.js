@@ -16,8 +16,8 @@
                     'or magnifying glass icon to add more.'
                 );
                 var field_name = $(field).attr('name');
-                var ids = escape($(field).val());
-                if (ids){
+                var raw_ids = $(field).val();
+                if (raw_ids){
                     var url_base = window.cooked_id_url_base || (
                         location.pathname.endsWith('/add/') ?
                             '../' : '../../'
@@ -26,73 +26,237 @@
                     if (is_inline_field) {
                         var model_name = $(field).attr('data-model');
                         field_name = $(field).attr('data-field');
-                        cook_url = url_base + 'cook-ids-inline/' + model_name + '/' + field_name + '/' + ids + '/';
+                        cook_url = url_base + 'cook-ids-inline/' + model_name + '/' + field_name + '/';
                     } else {
-                        cook_url = url_base + 'cook-ids/' + field_name + '/' + ids + '/';
+                        cook_url = url_base + 'cook-ids/' + field_name + '/';
                     }
-                    $.get(cook_url, function(response){
-                        var cooked = $('.cooked-data', container);
+                    var cooked = $('.cooked-data', container);
+                    var model = $(field).attr('data-cooked-model');
+                    // cook() may differ per field, so cache per cook URL
+                    var scope = $('<a>').attr('href', cook_url).prop('href');
+                    note_cooked_version(
+                        model, $(field).attr('data-cooked-version'));
+                    var ids = $.grep(raw_ids.split(','), function(id){
+                        return id !== '';
+                    });
+                    var positions = {};
+                    $.each(ids, function(index, id){ positions[id] = index; });
+                    var rendered = []; // positions of items shown, in order
+                    var render = function(){
                         cooked.html('');
-                        $.each(response, function(key, data){
-                            if (is_inline_field) {
-                                if (is_stacked_inline_field) {
-                                    $('<li data-id="'+key+'"></li>').text(data['text']).append(
-                                        ' <a onclick="remove_stacked_inline_cooked_item(this);"' +
-                                        ' title="remove">&nbsp;</a>'
-                                    ).appendTo(cooked);
-                                } else {
-                                    $('<li data-id="'+key+'"></li>').text(data['text']).append(
-                                        ' <a onclick="remove_tabular_inline_cooked_item(this);"' +
-                                        ' title="remove">&nbsp;</a>'
-                                    ).appendTo(cooked);
-                                }
-                            } else {
-                                $('<li data-id="'+key+'"></li>').text(data['text']).append(
-                                    ' <a onclick="remove_cooked_item(this);"' +
-                                    ' title="remove">&nbsp;</a>'
-                                ).appendTo(cooked);
+                        rendered = [];
+                        $.each(ids, function(index, id){
+                            var data = get_cooked(model, scope, id);
+                            if (data) {
+                                render_cooked_item(
+                                    cooked, id, data,
+                                    is_inline_field, is_stacked_inline_field
+                                );
+                                rendered.push(index);
+                            }
+                        });
+                    };
+                    render(); // whatever we already know about
+                    var render_chunk = function(response){
+                        // add just the chunk's items, each in its place
+                        var keys = $.grep($.map(response, function(data, key){
+                            return key;
+                        }), function(key){ return key in positions; });
+                        keys.sort(function(a, b){
+                            return positions[a] - positions[b];
+                        });
+                        $.each(keys, function(i, key){
+                            var index = positions[key];
+                            var low = 0, high = rendered.length;
+                            while (low < high) {
+                                var middle = (low + high) >> 1;
+                                if (rendered[middle] < index) low = middle + 1;
+                                else high = middle;
                             }
-                            
-                            if(data['can_view'] || data['can_edit']) {
-                                var options = {};
-                                if(data['can_view'])
-                                {
-                                    options['View'] = {click: function(element) {  
-                                        window.location.href = data['can_view'];
-                                    }}
-                                }
-                                if(data['can_edit']) {
-                                    options['Edit'] = {click: function(element) {  
-                                        window.location.href = data['base_url'] + key + '/';
-                                    }}
-                                }
-
-                                $('li[data-id='+key+']').contextMenu('context-menu-'+key, options);
+                            if (rendered[low] === index) return; // shown
+                            var item = render_cooked_item(
+                                cooked, key, response[key],
+                                is_inline_field, is_stacked_inline_field
+                            );
+                            if (low < rendered.length) {
+                                item.insertBefore(cooked[0].children[low]);
                             }
+                            rendered.splice(low, 0, index);
+                        });
+                    };
+                    var unknown_ids = $.grep(ids, function(id){
+                        return !get_cooked(model, scope, id);
+                    });
+                    if (!unknown_ids.length) return;
 
-														if(data['view_url'] || data['edit_url']) {
-																var options = {};
-																if(data['view_url'])
-																{
-																		options['View'] = {click: function(element) {
-																				window.location.href = data['view_url'];
-																			}
-																		}
-																}
-																if(data['edit_url'])
-																{
-																		options['Edit'] = {click: function(element) {
-																				window.location.href = data['edit_url'];
-																			}
-																		}
-																}
-
-																$('li[data-id='+key+']').contextMenu('context-menu-'+key, options);
-														}
-
+                    // ignore responses superseded by later field changes
+                    var request_id = (($(field).data('cooked_request_id') || 0) + 1);
+                    $(field).data('cooked_request_id', request_id);
+                    var is_current = function(){
+                        return $(field).data('cooked_request_id') == request_id;
+                    };
+                    var store_chunk = function(response, version){
+                        note_cooked_version(model, version);
+                        $.each(response, function(key, data){
+                            set_cooked(model, scope, key, data);
                         });
+                        if (is_current()) render_chunk(response);
+                    };
+                    if (unknown_ids.length > cooked_id_post_threshold) {
+                        stream_cooked_ids(
+                            cook_url, unknown_ids.join(','), store_chunk);
+                    } else {
+                        $.get(
+                            cook_url + escape(unknown_ids.join(',')) + '/',
+                            function(response, status, xhr){
+                                store_chunk(
+                                    response,
+                                    xhr.getResponseHeader('X-Cooked-Version')
+                                );
+                            }
+                        );
+                    }
+                }
+            };
+
+            // Cooked data is cached in memory and in sessionStorage, keyed by
+            // model, cook URL and pk. Entries are only valid for the model's
+            // current version stamp, which the server bumps whenever one
+            // changes.
+            var cooked_versions = {};
+            var cooked_cache = {};
+            var cooked_storage = null;
+            try {
+                cooked_storage = window.sessionStorage;
+            } catch (e) {} // e.g. disabled cookies
+
+            var note_cooked_version = function(model, version){
+                if (model && version) cooked_versions[model] = version;
+            };
+
+            var get_cooked = function(model, scope, id){
+                if (!model) return null;
+                var key = 'cooked:' + model + ':' + scope + ':' + id;
+                var entry = cooked_cache[key];
+                if (!entry && cooked_storage) {
+                    try {
+                        entry = $.parseJSON(cooked_storage.getItem(key));
+                    } catch (e) {}
+                }
+                if (!entry || entry['v'] !== cooked_versions[model]) {
+                    delete cooked_cache[key];
+                    if (entry && cooked_storage) cooked_storage.removeItem(key);
+                    return null;
+                }
+                cooked_cache[key] = entry;
+                return entry['d'];
+            };
+
+            var set_cooked = function(model, scope, id, data){
+                if (!model) return;
+                var key = 'cooked:' + model + ':' + scope + ':' + id;
+                var entry = {'v': cooked_versions[model], 'd': data};
+                cooked_cache[key] = entry;
+                if (cooked_storage) {
+                    try {
+                        cooked_storage.setItem(key, JSON.stringify(entry));
+                    } catch (e) {} // quota exceeded; memory will do
+                }
+            };
+
+            // coalesce rapid edits (e.g. typing ids) into a single update
+            var cooked_update_delay = window.cooked_update_delay || 250;
+            var schedule_cooked_update = function(field, is_inline_field, is_stacked_inline_field){
+                clearTimeout($(field).data('cooked_update_timer'));
+                $(field).data('cooked_update_timer', setTimeout(function(){
+                    update_cooked_field(
+                        field, is_inline_field, is_stacked_inline_field);
+                }, cooked_update_delay));
+            };
+
+            // selections larger than this are cooked via a streamed POST,
+            // since very long cook-ids URLs get rejected by proxies
+            var cooked_id_post_threshold = window.cooked_id_post_threshold || 200;
+
+            var stream_cooked_ids = function(cook_url, raw_ids, on_chunk){
+                // the response is newline-delimited JSON, one object per
+                // server-side chunk; handle each as soon as it arrives
+                var xhr = new XMLHttpRequest();
+                var offset = 0;
+                var consume = function(){
+                    var text = xhr.responseText;
+                    var end = text.lastIndexOf('\n');
+                    if (end < offset) return;
+                    var lines = text.substring(offset, end).split('\n');
+                    offset = end + 1;
+                    var version = xhr.getResponseHeader('X-Cooked-Version');
+                    $.each(lines, function(index, line){
+                        if (line) on_chunk($.parseJSON(line), version);
                     });
+                };
+                xhr.open('POST', cook_url);
+                xhr.setRequestHeader(
+                    'Content-Type', 'application/x-www-form-urlencoded');
+                xhr.setRequestHeader(
+                    'X-CSRFToken',
+                    $('input[name=csrfmiddlewaretoken]').val()
+                );
+                xhr.onprogress = consume;
+                xhr.onload = consume;
+                xhr.send('ids=' + encodeURIComponent(raw_ids));
+            };
+
+            var render_cooked_item = function(cooked, key, data, is_inline_field, is_stacked_inline_field){
+                var remove = 'remove_cooked_item';
+                if (is_inline_field) {
+                    if (is_stacked_inline_field) {
+                        remove = 'remove_stacked_inline_cooked_item';
+                    } else {
+                        remove = 'remove_tabular_inline_cooked_item';
+                    }
+                }
+                var item = $('<li data-id="'+key+'"></li>').text(data['text']).append(
+                    ' <a onclick="' + remove + '(this);"' +
+                    ' title="remove">&nbsp;</a>'
+                ).appendTo(cooked);
+
+                if(data['can_view'] || data['can_edit']) {
+                    var options = {};
+                    if(data['can_view'])
+                    {
+                        options['View'] = {click: function(element) {  
+                            window.location.href = data['can_view'];
+                        }}
+                    }
+                    if(data['can_edit']) {
+                        options['Edit'] = {click: function(element) {  
+                            window.location.href = data['base_url'] + key + '/';
+                        }}
+                    }
+
+                    item.contextMenu('context-menu-'+key, options);
+                }
+
+                if(data['view_url'] || data['edit_url']) {
+                    var options = {};
+                    if(data['view_url'])
+                    {
+                        options['View'] = {click: function(element) {
+                                window.location.href = data['view_url'];
+                            }
+                        }
+                    }
+                    if(data['edit_url'])
+                    {
+                        options['Edit'] = {click: function(element) {
+                                window.location.href = data['edit_url'];
+                            }
+                        }
+                    }
+
+                    item.contextMenu('context-menu-'+key, options);
                 }
+                return item;
             };
 
             window.remove_cooked_item = function(remove_link){
@@ -157,7 +321,7 @@
                     update_cooked_field(element);
                     $(element).bind(
                         'change', function(event){
-                            update_cooked_field(event.target);
+                            schedule_cooked_update(event.target);
                         }
                     );
                 }
@@ -167,7 +331,7 @@
                     update_cooked_field(element, true);
                     $(element).bind(
                         'change', function(event){
-                            update_cooked_field(event.target, true);
+                            schedule_cooked_update(event.target, true);
                         }
                     );
                 }
@@ -177,7 +341,7 @@
                     update_cooked_field(element, true, true);
                     $(element).bind(
                         'change', function(event){
-                            update_cooked_field(event.target, true, true);
+                            schedule_cooked_update(event.target, true, true);
                         }
                     );
                 }
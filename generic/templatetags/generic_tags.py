@@ -26,6 +26,8 @@ from django.utils.encoding import force_text
 from django.utils.html import strip_tags
 from django.utils.safestring import mark_safe
 
+from ..mixins import get_leaf_objects
+
 register = template.Library()
 
 @register.inclusion_tag('_field.html')
@@ -562,3 +564,17 @@ def file_exists(field_file):
             raise
         else:
             return None
+
+
+@register.filter
+def leaf_objects(objects):
+    """
+    Resolves a list/queryset of Inheritable objects to their leaf instances
+    in bulk, so that displaying them doesn't query once per object. E.g.
+
+      {% for item in object.related_items.all|leaf_objects %}
+        {{ item }}
+      {% endfor %}
+
+    """
+    return get_leaf_objects(objects)
@@ -1,7 +1,65 @@
+import datetime
+import json
+import time
+from io import StringIO
+from unittest import mock
+
 from django import http
-from django.test import TestCase
+from django.conf.urls import url
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, models
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, isolate_apps
+from django.utils import timezone
 from . import decorators
+from .admin.mixins import (
+    CookedIdAdmin,
+    DelibleAdmin,
+    InheritableAdmin,
+    PolymorphicAdmin,
+    SubclassFilter,
+)
+from .mixins import (
+    AutoNowQuerySet,
+    ChangedSinceIndex,
+    HousekeepingMixin,
+    Inheritable,
+    InheritableQuerySet,
+    LeafContentTypeMixin,
+    SubclassTypeMixin,
+    changed_since,
+    get_changed_since_cursor,
+)
+from .models import Relatable, RelatedItemRank
+from .models.delible import (
+    Delible,
+    DelibleArchive,
+    DelibleIndex,
+    DelibleManager,
+    is_live_index,
+)
+from .models import update_related_rankings as models_update_related_rankings
+from .utils.inheritance import get_subclasses, registry
+from .views.mixins import ChangedSinceView
+from .utils.cache import (
+    MAX_CACHE_KEY_LENGTH,
+    clear_local_caches,
+    collect_cache_method_stats,
+    flush_cache_method_stats,
+    get_safe_cache_key,
+    merge_cache_method_stats,
+)
 
 request_factory = RequestFactory()
 
@@ -13,6 +71,169 @@ def return_dict(request):
 def return_http_response(request):
     return http.HttpResponse('test')
 
+class Label(models.Model):
+    name = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'generic'
+
+    def __str__(self):
+        return self.name
+
+
+class Labelled(models.Model):
+    label = models.ForeignKey(Label, on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'generic'
+
+
+class LabelledAdmin(CookedIdAdmin):
+    cooked_id_fields = ('label',)
+    cooked_id_chunk_size = 2
+
+
+class Animal(SubclassTypeMixin, LeafContentTypeMixin, Inheritable,
+             models.Model):
+    name = models.CharField(max_length=20, blank=True)
+
+    objects = InheritableQuerySet.as_manager()
+
+    class Meta:
+        app_label = 'generic'
+
+
+class Dog(Animal):
+    class Meta:
+        app_label = 'generic'
+
+
+class Puppy(Dog):
+    class Meta:
+        app_label = 'generic'
+
+
+class Cat(Animal):
+    class Meta:
+        app_label = 'generic'
+
+
+class Folder(Delible):
+    name = models.CharField(max_length=20, blank=True)
+
+    soft_delete_cascade = True
+
+    objects = DelibleManager()
+
+    class Meta:
+        app_label = 'generic'
+
+
+class Doc(Delible):
+    folder = models.ForeignKey(Folder, on_delete=models.CASCADE)
+    modified = models.TimeField(auto_now=True)
+
+    objects = DelibleManager()
+
+    class Meta:
+        app_label = 'generic'
+        indexes = [DelibleIndex(fields=['folder'])]
+
+
+class Stamp(models.Model):
+    doc = models.ForeignKey(Doc, on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'generic'
+
+
+class Pin(models.Model):
+    folder = models.ForeignKey(Folder, on_delete=models.PROTECT)
+
+    class Meta:
+        app_label = 'generic'
+
+
+class ScopedDocAdmin(DelibleAdmin):
+    def get_queryset(self, request):
+        return super(ScopedDocAdmin, self).get_queryset(request).filter(
+            folder__name='mine')
+
+
+class StampAdmin(admin.ModelAdmin):
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class Timed(models.Model):
+    name = models.CharField(max_length=20, blank=True)
+    day = models.DateField(auto_now=True)
+    time = models.TimeField(auto_now=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = AutoNowQuerySet.as_manager()
+
+    class Meta:
+        app_label = 'generic'
+
+
+class Note(HousekeepingMixin):
+    text = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'generic'
+        indexes = [ChangedSinceIndex()]
+
+
+class CountingSubclassFilter(SubclassFilter):
+    show_counts = True
+
+
+class InitialFilter(admin.SimpleListFilter):
+    title = 'initial'
+    parameter_name = 'initial'
+
+    def lookups(self, request, model_admin):
+        names = model_admin.get_queryset(request).values_list(
+            'name', flat=True)
+        return sorted(set((name[:1], name[:1].upper()) for name in names))
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(name__startswith=self.value())
+
+
+class AnimalAdmin(PolymorphicAdmin):
+    list_display = ('__str__', 'name')
+    list_filter = (CountingSubclassFilter, InitialFilter)
+    search_fields = ('name',)
+    list_editable = ('name',)
+    lazy_subclass_resolution = True
+
+
+class LeafAnimalAdmin(InheritableAdmin):
+    list_display = ('__str__', 'name')
+    list_editable = ('name',)
+
+
+site = admin.AdminSite()
+site.register(Label)
+site.register(Labelled, LabelledAdmin)
+site.register(Animal, LeafAnimalAdmin)
+site.register(Folder, DelibleAdmin)
+site.register(Doc, DelibleAdmin)
+site.register(Stamp, StampAdmin)
+
+polymorphic_site = admin.AdminSite(name='polymorphic')
+polymorphic_site.register(Animal, AnimalAdmin)
+
+urlpatterns = [
+    url(r'^admin/', site.urls),
+    url(r'^polymorphic/', polymorphic_site.urls),
+    url(r'^sync/notes/$', ChangedSinceView.as_view(model=Note, paginate_by=2)),
+]
+
+
 class GenericTest(TestCase):
     def test_json_view_with_dict(self):
         request = request_factory.get('/')
@@ -25,3 +246,915 @@ class GenericTest(TestCase):
         response = return_http_response(request)
         self.assertTrue('text/html' in response['Content-Type'])
         self.assertEqual(response.content, 'test')
+
+
+class Cached(object):
+    pk = 1
+
+    def __init__(self):
+        self.calls = 0
+
+    @decorators.cache_method(timeout=60)
+    def get_nothing(self, *args):
+        self.calls += 1
+        return None
+
+    @decorators.cache_method(timeout=60, stale_timeout=60)
+    def get_calls(self):
+        self.calls += 1
+        return self.calls
+
+    @decorators.cache_method(timeout=60, local_timeout=5)
+    def get_local_calls(self):
+        self.calls += 1
+        return self.calls
+
+
+class CachedRelatable(Relatable):
+    calls = 0
+
+    class Meta:
+        proxy = True
+        app_label = 'generic'
+
+    @decorators.cache_method(invalidate_on_save=True)
+    def get_calls(self):
+        CachedRelatable.calls += 1
+        return CachedRelatable.calls
+
+
+class CacheMethodTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_caches()
+        CachedRelatable.calls = 0
+
+    def test_safe_cache_key(self):
+        self.assertEqual(get_safe_cache_key('a-b:1'), 'a-b:1')
+        # characters memcached rejects, too many characters and, since
+        # they're several bytes each, any non-ASCII characters
+        for key in ('a b', 'a' * (MAX_CACHE_KEY_LENGTH + 1), '\xe9t\xe9'):
+            self.assertRegex(
+                get_safe_cache_key(key), r'^generic-[0-9a-f]{32}$')
+
+    def test_cached_none(self):
+        obj = Cached()
+        with mock.patch.object(cache, 'get', wraps=cache.get) as get:
+            self.assertEqual(obj.get_nothing(), None)
+            self.assertEqual(obj.get_nothing(), None)
+        self.assertEqual(obj.calls, 1)
+        self.assertEqual(get.call_count, 2)
+        obj.get_nothing(force_reload=True)
+        self.assertEqual(obj.calls, 2)
+
+    def test_timeout(self):
+        with mock.patch.object(cache, 'set') as set:
+            Cached().get_nothing()
+        self.assertEqual(set.call_args[0][2], 60)
+
+    def test_stale_while_revalidate(self):
+        obj = Cached()
+        key = decorators.get_cache_method_key(obj, 'get_calls', (), {})
+        self.assertEqual(obj.get_calls(), 1)
+        later = time.time() + 61
+        with mock.patch('time.time', return_value=later):
+            cache.add('%s-lease' % key, 1) # someone else is recomputing
+            self.assertEqual(obj.get_calls(), 1)
+            cache.delete('%s-lease' % key)
+            self.assertEqual(obj.get_calls(), 2)
+            self.assertEqual(obj.get_calls(), 2)
+        self.assertEqual(cache.get('%s-lease' % key), None)
+
+    def test_prefetch_stale(self):
+        obj = Cached()
+        key = decorators.get_cache_method_key(obj, 'get_calls', (), {})
+        self.assertEqual(obj.get_calls(), 1)
+        later = time.time() + 61
+        with mock.patch('time.time', return_value=later):
+            cache.add('%s-lease' % key, 1) # someone else is recomputing
+            self.assertEqual(
+                decorators.prefetch_cached_method([obj], 'get_calls'), [1])
+            cache.delete('%s-lease' % key)
+            self.assertEqual(
+                decorators.prefetch_cached_method([obj], 'get_calls'), [2])
+            self.assertEqual(cache.get(key).value, 2)
+        self.assertEqual(cache.get('%s-lease' % key), None)
+
+    def test_local_cache(self):
+        obj = Cached()
+        self.assertEqual(obj.get_local_calls(), 1)
+        with mock.patch.object(cache, 'get') as get:
+            self.assertEqual(obj.get_local_calls(), 1)
+        self.assertFalse(get.called)
+        Cached.get_local_calls.invalidate(obj)
+        self.assertEqual(obj.get_local_calls(), 2)
+        with mock.patch('time.time', return_value=time.time() + 6):
+            # expired locally, but not from the cache proper
+            with mock.patch.object(cache, 'get', wraps=cache.get) as get:
+                self.assertEqual(obj.get_local_calls(), 2)
+            self.assertTrue(get.called)
+
+    def test_invalidate_on_save(self):
+        obj = CachedRelatable.objects.create()
+        self.assertEqual(obj.get_calls(), 1)
+        self.assertEqual(obj.get_calls(), 1)
+        self.assertEqual(CachedRelatable.objects.get().get_calls(), 1)
+        obj.save()
+        self.assertEqual(obj.get_calls(), 2)
+        other = CachedRelatable.objects.create()
+        self.assertEqual(other.get_calls(), 3)
+        other.delete()
+        self.assertEqual(CachedRelatable.objects.get().get_calls(), 2)
+        # saved through the parent class, as e.g. PolymorphicAdmin would
+        Relatable.objects.get(pk=obj.pk).save()
+        self.assertEqual(CachedRelatable.objects.get().get_calls(), 4)
+
+    def test_prefetch(self):
+        objects = [CachedRelatable.objects.create() for i in range(3)]
+        objects[0].get_calls()
+        with mock.patch.object(
+                cache, 'get_many', wraps=cache.get_many) as get_many:
+            self.assertEqual(
+                decorators.prefetch_cached_method(objects, 'get_calls'),
+                [1, 2, 3])
+        self.assertEqual(get_many.call_count, 2) # generations, results
+        with mock.patch.object(cache, 'get') as get:
+            self.assertEqual([obj.get_calls() for obj in objects], [1, 2, 3])
+        self.assertFalse(get.called)
+        objects[1].save()
+        self.assertEqual(objects[1].get_calls(), 4)
+
+    def test_long_keys(self):
+        obj = Cached()
+        for args in (['x' * 300], ['a b'], ['x' * 300, 'y']):
+            key = decorators.get_cache_method_key(
+                obj, 'get_nothing', args, {})
+            self.assertTrue(len(key) <= decorators.MAX_CACHE_KEY_LENGTH)
+            self.assertFalse(' ' in key)
+            obj.get_nothing(*args)
+            obj.get_nothing(*args)
+        self.assertEqual(obj.calls, 3)
+
+    def test_stats(self):
+        stats = Cached.get_local_calls.stats
+        stats.reset()
+        obj = Cached()
+        obj.get_local_calls()
+        obj.get_local_calls()
+        clear_local_caches()
+        with mock.patch.object(cache, 'get', side_effect=Exception):
+            obj.get_local_calls()
+        snapshot = stats.snapshot()
+        self.assertEqual(
+            [snapshot[counter] for counter in (
+                'hits', 'local_hits', 'misses', 'errors')],
+            [1, 1, 2, 1])
+        self.assertEqual(sum(snapshot['compute_times']), 2)
+        self.assertEqual(snapshot['payload_samples'], 0) # not by default
+        with self.settings(GENERIC_CACHE_METHOD_STATS_PAYLOAD=1):
+            clear_local_caches()
+            cache.clear()
+            obj.get_local_calls()
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['misses'], 3)
+        self.assertEqual(snapshot['payload_samples'], 1)
+        self.assertTrue(snapshot['payload_max'] > 0)
+
+        flush_cache_method_stats()
+        name = '%s.Cached.get_local_calls' % __name__
+        merged = merge_cache_method_stats(
+            list(collect_cache_method_stats().values()) * 2)
+        self.assertEqual(merged[name]['misses'], 6)
+        self.assertEqual(merged[name]['payload_samples'], 2)
+        self.assertEqual(
+            merged[name]['payload_max'], snapshot['payload_max'])
+
+
+class RelatableTest(TestCase):
+    def setUp(self):
+        # a - b - c - d, plus a - e
+        self.a, self.b, self.c, self.d, self.e = [
+            Relatable.objects.create() for i in range(5)]
+        self.a.related_items.add(self.b, self.e)
+        self.b.related_items.add(self.c)
+        self.c.related_items.add(self.d)
+
+    def assertDistances(self, **kwargs):
+        expected = [
+            (self.b.pk, 1), (self.e.pk, 1), (self.c.pk, 2), (self.d.pk, 3)]
+        depth = kwargs.get('depth', 2)
+        expected = [item for item in expected if item[1] <= depth]
+        if kwargs.get('limit') is not None:
+            expected = expected[:kwargs['limit']]
+        self.assertEqual(self.a.get_related_distances(**kwargs), expected)
+
+    def test_related_distances(self):
+        self.assertDistances()
+        self.assertDistances(depth=3)
+        self.assertDistances(depth=3, limit=3)
+        self.assertEqual(
+            self.a.get_related_neighbourhood(depth=1),
+            [(self.b, 1), (self.e, 1)])
+
+    def test_related_distances_without_recursive_queries(self):
+        with mock.patch(
+                'generic.models.supports_recursive_cte', return_value=False):
+            self.assertDistances()
+            self.assertDistances(depth=3)
+            self.assertDistances(depth=3, limit=3)
+
+    def test_relate_pairs(self):
+        self.assertNumQueries(1, Relatable.relate_pairs, [
+            (self.a, self.b), (self.b, self.a), (self.d, self.e.pk)])
+        self.assertEqual(
+            set(self.e.related_items.all()), set([self.a, self.d]))
+        self.assertNumQueries(1, Relatable.unrelate_pairs, [
+            (self.b, self.a), (self.a, self.e), (self.b, self.d)])
+        self.assertEqual(list(self.a.related_items.all()), [])
+        self.assertEqual(list(self.e.related_items.all()), [self.d])
+        self.assertEqual(list(self.b.related_items.all()), [self.c])
+        # a useless batch size mustn't mean an unrestricted delete
+        Relatable.unrelate_pairs([(self.b, self.c)], batch_size=0)
+        self.assertEqual(list(self.b.related_items.all()), [])
+        self.assertEqual(list(self.c.related_items.all()), [self.d])
+        self.assertNumQueries(0, Relatable.unrelate_pairs, [])
+
+
+class RelatedItemRankTest(TransactionTestCase):
+    # rankings are updated on commit
+
+    def setUp(self):
+        self.a, self.b, self.c, self.d, self.e = [
+            Relatable.objects.create() for i in range(5)]
+        self.a.related_items.add(self.b, self.e)
+        self.b.related_items.add(self.c)
+        self.c.related_items.add(self.d)
+
+    def test_top_related(self):
+        with self.settings(GENERIC_RELATED_RANKING_SIZE=2):
+            self.b.related_items.add(self.e) # b and e now share a
+            self.assertEqual(self.a.get_top_related(), [self.e, self.b])
+            self.assertEqual(self.b.get_top_related(), [self.e, self.a])
+            self.c.related_items.add(self.a)
+            self.assertEqual(self.b.get_top_related(), [self.a, self.e])
+            self.b.related_items.clear()
+            self.assertEqual(self.b.get_top_related(), [])
+            self.assertEqual(self.a.get_top_related(limit=1), [self.e])
+            Relatable.relate_pairs([(self.b, self.e)])
+            self.assertEqual(self.b.get_top_related(), [self.e])
+            Relatable.unrelate_pairs([(self.e, self.b)])
+            self.assertEqual(self.b.get_top_related(), [])
+
+    def test_rebuild(self):
+        def get_rankings():
+            return list(RelatedItemRank.objects.order_by(
+                'item', 'rank').values_list('item', 'related_item', 'score'))
+        call_command('rebuild_related_rankings', size=2, stdout=StringIO())
+        rankings = get_rankings()
+        self.assertEqual(len(rankings), 8)
+        RelatedItemRank.objects.filter(item=self.a).update(score=0)
+        counts = []
+        def update_related_rankings(pks, size):
+            counts.append(RelatedItemRank.objects.count())
+            return models_update_related_rankings(pks, size)
+        with mock.patch(
+                'generic.management.commands.rebuild_related_rankings.'
+                'update_related_rankings', update_related_rankings):
+            call_command(
+                'rebuild_related_rankings', size=2, chunk_size=2,
+                stdout=StringIO())
+        self.assertEqual(get_rankings(), rankings)
+        self.assertEqual(counts, [len(rankings)] * 3) # never emptied
+
+    def test_update_locks(self):
+        select_for_update = models.QuerySet.select_for_update
+        with mock.patch.object(
+                models.QuerySet, 'select_for_update', autospec=True,
+                side_effect=select_for_update) as lock:
+            # including an item deleted meanwhile
+            models_update_related_rankings([self.c.pk, self.a.pk, 0], 2)
+        self.assertEqual(lock.call_count, 1)
+        self.assertEqual(
+            list(RelatedItemRank.objects.order_by('item', 'rank').values_list(
+                'item', flat=True)),
+            [self.a.pk] * 2 + [self.c.pk] * 2)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class CookedIdAdminTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        self.ids = ','.join(
+            str(Label.objects.create(name=name).pk) for name in 'abc')
+        self.url = '/admin/generic/labelled/cook-ids/label/'
+
+    def test_cook_ids(self):
+        response = self.client.get('%s%s/' % (self.url, self.ids))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['X-Cooked-Version'])
+        data = json.loads(response.content.decode())
+        self.assertEqual(
+            sorted(cooked['text'] for cooked in data.values()),
+            ['a', 'b', 'c'])
+
+    def test_cook_ids_post(self):
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        response = self.client.post(self.url, {'ids': self.ids})
+        self.assertEqual(response.status_code, 200)
+        chunks = [
+            json.loads(line) for line in b''.join(
+                response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(
+            [chunks[0][pk]['text'] for pk in sorted(chunks[0])], ['a', 'b'])
+
+
+class InheritanceRegistryTest(TestCase):
+    def setUp(self):
+        registry.build() # pick up the models above
+
+    def test_lookups(self):
+        with self.assertNumQueries(0):
+            descendants = registry.get_descendants(Animal)
+            self.assertEqual(set(descendants[:2]), set([Dog, Cat]))
+            self.assertEqual(descendants[2:], (Puppy,)) # shallowest first
+            self.assertEqual(registry.get_descendants(Dog), (Puppy,))
+            self.assertEqual(registry.get_descendants(Cat), ())
+            self.assertEqual(
+                [(name, str(title)) for name, title in
+                 registry.get_subclass_choices(Animal)],
+                [('cat', 'Cat'), ('dog', 'Dog')])
+            self.assertEqual(registry.get_subclass(Animal, 'dog'), Dog)
+            self.assertEqual(registry.get_subclass(Animal, 'puppy'), None)
+            self.assertEqual(
+                registry.get_parent_links(Puppy),
+                {Dog: Puppy._meta.get_field('dog_ptr')})
+            self.assertEqual(
+                set(get_subclasses(Animal)), set([Animal, Dog, Puppy, Cat]))
+
+
+class SubclassTypeTest(TestCase):
+    def setUp(self):
+        registry.build() # pick up the models above
+        self.animals = [
+            model.objects.create() for model in (Animal, Dog, Puppy, Cat)]
+
+    def assertTypes(self, *types):
+        self.assertEqual(
+            list(Animal.objects.order_by('pk').values_list(
+                'subclass_type', flat=True)),
+            list(types))
+
+    def test_subclass_type(self):
+        self.assertTypes(
+            'generic.animal', 'generic.dog', 'generic.puppy', 'generic.cat')
+        Animal.objects.get(pk=self.animals[2].pk).save() # not downgraded
+        self.assertEqual(
+            Animal.objects.get(pk=self.animals[2].pk).subclass_type,
+            'generic.puppy')
+
+    def test_filter(self):
+        subclass_filter = SubclassFilter(
+            None, {'type': 'dog'}, Animal, polymorphic_site._registry[Animal])
+        queryset = subclass_filter.queryset(None, Animal.objects.all())
+        self.assertEqual(
+            set(obj.pk for obj in queryset),
+            set(obj.pk for obj in self.animals[1:3])) # dog and puppy
+        self.assertFalse('generic_dog' in str(queryset.query)) # no join
+
+    def test_backfill(self):
+        Animal.objects.filter(pk=self.animals[1].pk).update(
+            subclass_type='generic.animal') # stale, so left alone
+        Animal.objects.exclude(pk=self.animals[1].pk).update(subclass_type='')
+        call_command('backfill_subclass_type', stdout=StringIO())
+        self.assertTypes(
+            'generic.animal', 'generic.animal', 'generic.puppy', 'generic.cat')
+        call_command(
+            'backfill_subclass_type', 'generic.Animal', '--all',
+            stdout=StringIO())
+        self.assertTypes(
+            'generic.animal', 'generic.dog', 'generic.puppy', 'generic.cat')
+        with self.assertRaises(CommandError):
+            call_command('backfill_subclass_type', 'generic.Label')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class PolymorphicAdminTest(TestCase):
+    def setUp(self):
+        registry.build() # pick up the models above
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        self.animals = [
+            model.objects.create(name=model.__name__.lower())
+            for model in (Animal, Dog, Puppy, Cat)
+        ]
+
+    def test_lazy_changelist(self):
+        url = '/polymorphic/generic/animal/'
+        with self.assertNumQueries(10):
+            # session, user, initials to filter by, 2 counts, type counts, the
+            # page, then one query per subclass present; the list_editable
+            # formset reuses the page
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [obj.__class__ for obj in response.context['cl'].result_list],
+            [Cat, Puppy, Dog, Animal])
+        self.assertEqual(
+            [form.instance.name for form in response.context['cl'].formset],
+            ['cat', 'puppy', 'dog', 'animal'])
+        data = {
+            'form-TOTAL_FORMS': '4',
+            'form-INITIAL_FORMS': '4',
+            '_save': 'Save',
+        }
+        for i, animal in enumerate(reversed(self.animals)):
+            data['form-%d-id' % i] = str(animal.pk)
+            data['form-%d-name' % i] = animal.name.upper()
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(
+            list(Animal.objects.order_by('pk').values_list('name', flat=True)),
+            ['ANIMAL', 'DOG', 'PUPPY', 'CAT'])
+
+    def test_resolve_subclasses(self):
+        model_admin = polymorphic_site._registry[Animal]
+        objects = list(Animal.objects.order_by('pk'))
+        with self.assertNumQueries(3): # one per subclass present
+            resolved = model_admin.resolve_subclasses(objects)
+        self.assertEqual(
+            [obj.__class__ for obj in resolved], [Animal, Dog, Puppy, Cat])
+        self.assertEqual(
+            [obj.pk for obj in resolved], [obj.pk for obj in self.animals])
+        with self.assertNumQueries(0): # already resolved
+            self.assertEqual(model_admin.resolve_subclasses(resolved), resolved)
+
+    def test_delete_selected_subclasses(self):
+        url = '/polymorphic/generic/animal/'
+        data = {
+            'action': 'delete_selected_subclasses',
+            '_selected_action': [str(obj.pk) for obj in self.animals[1:]],
+        }
+        response = self.client.post(url, data)
+        self.assertTemplateUsed(
+            response,
+            'admin/generic/delete_selected_subclasses_confirmation.html')
+        self.assertEqual(
+            [(group['opts'].model, len(group['objects']))
+             for group in response.context['groups']],
+            [(Cat, 1), (Puppy, 1), (Dog, 1)])
+        self.assertEqual(Animal.objects.count(), 4)
+        data['post'] = 'yes'
+        self.assertRedirects(
+            self.client.post(url, data), url, fetch_redirect_response=False)
+        self.assertEqual(list(Animal.objects.all()), self.animals[:1])
+        self.assertFalse(Dog.objects.exists())
+
+    def test_memoisation(self):
+        model_admin = polymorphic_site._registry[Animal]
+        request = request_factory.get('/', {'__subclass': 'dog'})
+        request.user = User.objects.get()
+        with mock.patch.object(
+                model_admin, 'get_modeladmin',
+                wraps=model_admin.get_modeladmin) as get_modeladmin:
+            form = model_admin.get_form(request)
+            self.assertIs(model_admin.get_form(request), form)
+            self.assertIs(
+                model_admin.get_fieldsets(request),
+                model_admin.get_fieldsets(request))
+        self.assertEqual(get_modeladmin.call_count, 2) # form, fieldsets
+        self.assertEqual(form._meta.model, Dog)
+        request = request_factory.get('/', {'__subclass': 'cat'})
+        request.user = User.objects.get()
+        self.assertEqual(model_admin.get_form(request)._meta.model, Cat)
+
+    def test_counts(self):
+        # counts reflect the search, but not the type filter itself
+        response = self.client.get(
+            '/polymorphic/generic/animal/', {'q': 'a', 'type': 'dog'})
+        self.assertEqual(list(response.context['cl'].result_list), [])
+        self.assertContains(response, 'Cat (1)')
+        self.assertContains(response, 'Dog (0)')
+        response = self.client.get(
+            '/polymorphic/generic/animal/', {'q': 'p'})
+        self.assertContains(response, 'Cat (0)')
+        self.assertContains(response, 'Dog (1)')
+        # and other filters and lookups, reusing the changelist's filters
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/polymorphic/generic/animal/', {
+                'type': 'dog', 'initial': 'p', 'name': 'puppy'})
+        self.assertEqual(
+            len([query for query in queries if query['sql'].startswith(
+                'SELECT "generic_animal"."name" FROM')]),
+            1) # initials to filter by
+        self.assertContains(response, 'Cat (0)')
+        self.assertContains(response, 'Dog (1)')
+        self.assertEqual(
+            [spec.value() for spec in response.context['cl'].filter_specs
+             if isinstance(spec, SubclassFilter)],
+            ['dog'])
+
+
+class LeafObjectsTest(TestCase):
+    def setUp(self):
+        registry.build() # pick up the models above
+        self.animals = [
+            model.objects.create() for model in (Animal, Dog, Puppy, Cat)]
+
+    def assertLeaves(self, queries):
+        with self.assertNumQueries(queries):
+            leaves = Animal.objects.order_by('pk').leaves()
+        self.assertEqual(
+            [obj.__class__ for obj in leaves], [Animal, Dog, Puppy, Cat])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [str(obj) for obj in leaves],
+                [str(obj) for obj in self.animals])
+
+    def test_stored_leaf_models(self):
+        self.assertLeaves(4) # one per leaf model present
+
+    def test_unknown_leaf_models(self):
+        Animal.objects.update(leaf_content_type=None)
+        self.assertLeaves(4) # one per descendant model
+
+
+class LeafContentTypeTest(TestCase):
+    def setUp(self):
+        registry.build() # pick up the models above
+        self.animals = [
+            model.objects.create() for model in (Animal, Dog, Puppy, Cat)]
+
+    def assertLeafModels(self, *models):
+        self.assertEqual(
+            [
+                content_type_id and
+                ContentType.objects.get_for_id(content_type_id).model_class()
+                for content_type_id in Animal.objects.order_by(
+                    'pk').values_list('leaf_content_type', flat=True)
+            ],
+            list(models))
+
+    def test_leaf_content_type(self):
+        self.assertLeafModels(Animal, Dog, Puppy, Cat)
+        Animal.objects.get(pk=self.animals[2].pk).save() # not downgraded
+        self.assertLeafModels(Animal, Dog, Puppy, Cat)
+        animal = Animal.objects.get(pk=self.animals[2].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(animal.get_leaf_object(), self.animals[2])
+
+    def test_backfill(self):
+        Animal.objects.filter(pk=self.animals[1].pk).update(
+            leaf_content_type=ContentType.objects.get_for_model(Animal))
+        Animal.objects.exclude(pk=self.animals[1].pk).update(
+            leaf_content_type=None)
+        call_command('backfill_leaf_content_type', stdout=StringIO())
+        self.assertLeafModels(Animal, Animal, Puppy, Cat)
+        call_command(
+            'backfill_leaf_content_type', 'generic.Animal', '--all',
+            stdout=StringIO())
+        self.assertLeafModels(Animal, Dog, Puppy, Cat)
+        with self.assertRaises(CommandError):
+            call_command('backfill_leaf_content_type', 'generic.Label')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class InheritableAdminTest(TestCase):
+    def setUp(self):
+        registry.build() # pick up the models above
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        for model in (Animal, Dog, Puppy, Cat):
+            model.objects.create(name=model.__name__.lower())
+
+    def test_leaf_changelist(self):
+        with self.assertNumQueries(8):
+            # session, user, 2 counts, the page, then one query per leaf
+            # class present; the list_editable formset reuses the page
+            response = self.client.get('/admin/generic/animal/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [obj.__class__ for obj in response.context['cl'].result_list],
+            [Cat, Puppy, Dog, Animal])
+        self.assertContains(response, 'Puppy object (')
+
+
+class DelibleIndexTest(SimpleTestCase):
+    def test_index(self):
+        index = Doc._meta.indexes[0]
+        self.assertTrue(index.name.endswith('_liv')) # named automatically
+        self.assertEqual(index.condition, models.Q(deleted=None))
+        path, args, kwargs = index.deconstruct()
+        self.assertEqual(path, 'django.db.models.Index')
+        self.assertEqual(kwargs['fields'], ['folder'])
+        self.assertEqual(kwargs['condition'], models.Q(deleted=None))
+        self.assertTrue(is_live_index(index))
+        self.assertTrue(is_live_index(models.Index(
+            fields=['folder'], name='folder_live',
+            condition=models.Q(deleted__isnull=True))))
+        self.assertFalse(is_live_index(
+            models.Index(fields=['folder'], name='folder_all')))
+
+    @isolate_apps('generic')
+    def test_check(self):
+        class Uncovered(Delible):
+            code = models.CharField(max_length=5, db_index=True)
+            objects = DelibleManager()
+
+        class Covered(Delible):
+            code = models.CharField(max_length=5, db_index=True)
+            objects = DelibleManager()
+
+            class Meta:
+                indexes = [DelibleIndex(fields=['code', 'deleted_by'])]
+
+        class Together(Delible):
+            a = models.IntegerField()
+            b = models.IntegerField()
+            objects = DelibleManager()
+
+            class Meta:
+                index_together = [('a', 'b')]
+                indexes = [DelibleIndex(fields=['a'])] # too short
+
+        class TogetherCovered(Delible):
+            a = models.IntegerField()
+            b = models.IntegerField()
+            objects = DelibleManager()
+
+            class Meta:
+                index_together = [('a', 'b')]
+                indexes = [DelibleIndex(fields=['a', 'b', '-deleted'])]
+
+        class Unfiltered(Delible):
+            code = models.CharField(max_length=5, db_index=True)
+
+        warnings = Uncovered._check_live_indexes()
+        self.assertEqual([warning.id for warning in warnings], ['generic.W001'])
+        self.assertIn('(code)', warnings[0].msg)
+        warnings = Together._check_live_indexes()
+        self.assertEqual([warning.id for warning in warnings], ['generic.W001'])
+        self.assertIn('(a, b)', warnings[0].msg)
+        for model in (Covered, TogetherCovered, Unfiltered):
+            self.assertEqual(model._check_live_indexes(), [])
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class DelibleTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        self.folder = Folder.objects.create()
+        self.docs = [Doc.objects.create(folder=self.folder) for i in range(3)]
+        Stamp.objects.create(doc=self.docs[0])
+
+    def test_delete(self):
+        request = request_factory.post('/')
+        request.user = self.user
+        docs = Doc.objects.filter(pk__in=[doc.pk for doc in self.docs[:2]])
+        with self.assertNumQueries(3): # savepoint, UPDATE, release
+            self.assertEqual(docs.delete(request=request), 2)
+        self.assertEqual(list(Doc.objects.all()), self.docs[2:])
+        self.assertEqual(
+            set(Doc.objects.deleted().values_list('deleted_by', flat=True)),
+            set([self.user.pk]))
+        self.assertTrue(Stamp.objects.exists()) # left alone
+        # already deleted objects keep their original stamp
+        self.assertEqual(Doc.objects.all_with_deleted().delete(), 1)
+        self.assertEqual(
+            Doc.objects.deleted().filter(pk=self.docs[0].pk).undelete(), 1)
+        self.assertEqual(list(Doc.objects.all()), self.docs[:1])
+        Doc.objects.all_with_deleted().hard_delete()
+        self.assertFalse(Doc.objects.all_with_deleted().exists())
+        self.assertFalse(Stamp.objects.exists())
+
+    def test_admin_actions(self):
+        self.client.force_login(self.user)
+        url = '/admin/generic/doc/'
+        data = {
+            'action': 'delete_selected',
+            '_selected_action': [str(doc.pk) for doc in self.docs[:2]],
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(len(response.context['deletable_objects'][0]), 2)
+        self.assertEqual(dict(response.context['model_count']), {'docs': 2})
+        self.assertFalse(response.context['perms_lacking']) # e.g. of stamps
+        data['post'] = 'yes'
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(list(Doc.objects.all()), self.docs[2:])
+        self.assertEqual(
+            Doc.objects.deleted().filter(deleted_by=self.user).count(), 2)
+        self.assertTrue(Stamp.objects.exists())
+        data = {
+            'action': 'undelete_selected',
+            '_selected_action': [str(self.docs[0].pk)],
+        }
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(
+            list(Doc.objects.order_by('pk')), [self.docs[0], self.docs[2]])
+
+    def test_undelete_scope(self):
+        mine = Doc.objects.create(folder=Folder.objects.create(name='mine'))
+        Doc.objects.all().delete()
+        request = request_factory.post('/', {
+            '_selected_action': [str(mine.pk), str(self.docs[0].pk)]})
+        request.user = self.user
+        model_admin = ScopedDocAdmin(Doc, site)
+        self.assertEqual(
+            list(model_admin.get_undelete_queryset(request)), [mine])
+        with mock.patch.object(model_admin, 'message_user'):
+            model_admin.undelete_selected(request, Doc.objects.none())
+        self.assertEqual(list(Doc.objects.all()), [mine])
+        self.assertEqual(
+            list(model_admin.get_queryset(request)), [mine]) # live only
+
+    def test_cascade(self):
+        earlier = self.docs[2]
+        Doc.objects.filter(pk=earlier.pk).delete()
+        earlier.refresh_from_db()
+        with self.assertNumQueries(4): # savepoint, UPDATE per level, release
+            self.assertEqual(
+                Folder.objects.filter(pk=self.folder.pk).delete(), 1)
+        self.folder.refresh_from_db()
+        self.assertEqual(
+            set(Doc.objects.deleted().filter(
+                deleted=self.folder.deleted).values_list('pk', flat=True)),
+            set(doc.pk for doc in self.docs[:2]))
+        self.assertEqual(
+            Doc.objects.deleted().get(pk=earlier.pk).deleted, earlier.deleted)
+        Folder.objects.deleted().undelete()
+        self.assertEqual(list(Doc.objects.order_by('pk')), self.docs[:2])
+        self.assertTrue(Doc.objects.deleted().filter(pk=earlier.pk).exists())
+
+        self.folder.refresh_from_db()
+        self.folder.delete(cascade=False)
+        self.assertEqual(Doc.objects.count(), 2)
+        self.folder.undelete()
+        self.folder.delete()
+        self.assertFalse(Doc.objects.exists())
+        self.folder.undelete()
+        self.assertEqual(list(Doc.objects.order_by('pk')), self.docs[:2])
+
+    def test_cascade_confirmation(self):
+        self.docs[2].delete()
+        self.client.force_login(self.user)
+        response = self.client.post('/admin/generic/folder/', {
+            'action': 'delete_selected',
+            '_selected_action': [str(self.folder.pk)],
+        })
+        folder, docs = response.context['deletable_objects'][0]
+        self.assertIn('Folder: ', folder)
+        self.assertEqual(len(docs), 2) # not the one already deleted
+        self.assertEqual(
+            dict(response.context['model_count']), {'folders': 1, 'docs': 2})
+        self.assertFalse(response.context['perms_lacking'])
+
+
+class PurgeDeletedTest(TestCase):
+    def test_purge(self):
+        orphaning = Folder.objects.create(name='orphaning')
+        live = Doc.objects.create(folder=orphaning)
+        purged = Folder.objects.create(name='purged')
+        Stamp.objects.create(doc=Doc.objects.create(folder=purged))
+        recent = Folder.objects.create(name='recent')
+        pinned = Folder.objects.create(name='pinned')
+        Pin.objects.create(folder=pinned)
+        Folder.objects.filter(pk=orphaning.pk).delete(cascade=False)
+        Folder.objects.filter(
+            pk__in=[purged.pk, recent.pk, pinned.pk]).delete()
+        old = datetime.datetime.now() - datetime.timedelta(days=40)
+        Folder.objects.deleted().exclude(pk=recent.pk).update(deleted=old)
+        Doc.objects.deleted().update(deleted=old)
+
+        out = StringIO()
+        call_command('purge_deleted', 'generic.Folder', dry_run=True,
+                     stdout=out)
+        self.assertEqual(
+            out.getvalue(), 'generic.Folder: 1 rows would be purged, '
+            '2 skipped (live or protected objects depend on them)\n')
+        self.assertEqual(Folder.objects.all_with_deleted().count(), 4)
+
+        out = StringIO()
+        call_command('purge_deleted', 'generic.Folder', archive=True,
+                     stdout=out)
+        self.assertEqual(
+            out.getvalue(), 'generic.Folder: 1 rows archived, '
+            '2 skipped (live or protected objects depend on them)\n')
+        self.assertEqual(
+            set(Folder.objects.all_with_deleted()),
+            set([orphaning, recent, pinned]))
+        self.assertEqual(list(Doc.objects.all_with_deleted()), [live])
+        self.assertFalse(Stamp.objects.exists())
+        self.assertEqual(
+            sorted(DelibleArchive.objects.values_list(
+                'content_type__model', flat=True)),
+            ['doc', 'folder', 'stamp'])
+        self.assertEqual(
+            json.loads(DelibleArchive.objects.get(
+                content_type__model='folder').data)['name'], 'purged')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ChangedSinceTest(TestCase):
+    def setUp(self):
+        self.notes = [Note.objects.create(text=str(i)) for i in range(5)]
+        # e.g. as stamped by a single update(); naive or aware, as per USE_TZ
+        self.same = timezone.now() - datetime.timedelta(days=1)
+        Note.objects.filter(
+            pk__in=[note.pk for note in self.notes[:3]]).update(
+                date_modified=self.same)
+        Note.objects.filter(pk=self.notes[1].pk).update(
+            deleted=True, date_modified=self.same)
+        for note in self.notes:
+            note.refresh_from_db()
+        self.pks = [note.pk for note in self.notes]
+
+    def test_changed_since(self):
+        def pks(cursor=None):
+            return list(changed_since(Note.objects.all(), cursor).values_list(
+                'pk', flat=True))
+
+        self.assertEqual(pks(), self.pks)
+        self.assertEqual(
+            pks(get_changed_since_cursor(self.notes[0])), self.pks[1:])
+        self.assertEqual(
+            pks((self.same, self.notes[2].pk)), self.pks[3:])
+        self.assertEqual(
+            list(Note.objects.changed_since(
+                get_changed_since_cursor(self.notes[4]))), [])
+
+    def test_view(self):
+        pages = []
+        cursor = None
+        while True:
+            response = self.client.get(
+                '/sync/notes/', {'since': cursor} if cursor else {})
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.content.decode('utf-8'))
+            pages.append([obj['pk'] for obj in page['objects']])
+            cursor = page['cursor']
+            if not page['more']:
+                break
+            if len(pages) == 1:
+                self.assertEqual(
+                    page['objects'][0]['fields']['text'], '0')
+                self.assertEqual(
+                    page['objects'][1],
+                    {'pk': self.notes[1].pk, 'deleted': True})
+        self.assertEqual(pages, [self.pks[:2], self.pks[2:4], self.pks[4:]])
+        # nothing new; the cursor stays put
+        page = json.loads(self.client.get(
+            '/sync/notes/', {'since': cursor}).content.decode('utf-8'))
+        self.assertEqual(page, {'objects': [], 'cursor': cursor, 'more': False})
+
+    def test_invalid_cursor(self):
+        for cursor in ('nonsense', 'yesterday,1', '2020-01-01T00:00:00,x'):
+            response = self.client.get('/sync/notes/', {'since': cursor})
+            self.assertEqual(response.status_code, 400)
+
+
+class AutoNowTest(TestCase):
+    def setUp(self):
+        self.old = {
+            'day': datetime.date(2000, 1, 1),
+            'time': datetime.time(0, 0),
+            # naive or aware, as per USE_TZ
+            'modified': timezone.now() - datetime.timedelta(days=365),
+        }
+
+    def assertStamped(self, obj):
+        obj.refresh_from_db()
+        self.assertEqual(obj.day, datetime.date.today())
+        self.assertNotEqual(obj.time, self.old['time'])
+        self.assertGreater(obj.modified, self.old['modified'])
+
+    def test_update(self):
+        timed = Timed.objects.create()
+        Timed.objects.update(**self.old) # explicit values win
+        timed.refresh_from_db()
+        self.assertEqual(timed.time, self.old['time'])
+        Timed.objects.update(name='updated')
+        self.assertStamped(timed)
+
+    def test_bulk_update(self):
+        timed = Timed.objects.create()
+        Timed.objects.update(**self.old)
+        timed.name = 'updated'
+        Timed.objects.bulk_update([timed], ['name'])
+        self.assertStamped(timed)
+
+    def test_cascade(self):
+        folder = Folder.objects.create()
+        doc = Doc.objects.create(folder=folder)
+        old = self.old['time']
+        Doc.objects.update(modified=old)
+        folder.delete()
+        doc.refresh_from_db()
+        self.assertTrue(doc.is_deleted())
+        self.assertNotEqual(doc.modified, old)
+        Doc.objects.all_with_deleted().update(modified=old)
+        folder.undelete()
+        doc.refresh_from_db()
+        self.assertFalse(doc.is_deleted())
+        self.assertNotEqual(doc.modified, old)
@@ -0,0 +1,431 @@
+import bisect
+import hashlib
+import logging
+import os
+import pickle
+import random
+import socket
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.apps import apps
+from django.core.cache import caches
+from django.db.models.signals import class_prepared, post_delete, post_save
+
+logger = logging.getLogger(__name__)
+
+# leaves room for KEY_PREFIX and version within memcached's 250 characters
+MAX_CACHE_KEY_LENGTH = 200
+
+
+def get_safe_cache_key(cache_key, prefix='generic'):
+    """
+    Returns `cache_key`, or if it's too long or otherwise unsafe for
+    memcached, `prefix` plus a hash of it. Keys with non-ASCII characters are
+    hashed too, so the length checked is also the length in bytes.
+    """
+    if len(cache_key) > MAX_CACHE_KEY_LENGTH or any(
+            ord(char) < 33 or ord(char) > 126 for char in cache_key):
+        cache_key = '%s-%s' % (
+            prefix[:MAX_CACHE_KEY_LENGTH - 33],
+            hashlib.md5(cache_key.encode('utf-8')).hexdigest(),
+        )
+    return cache_key
+
+
+class LocalCache(object):
+    """
+    Bounded, thread-safe, in-process LRU cache whose entries expire after
+    `timeout` seconds; e.g. as a first tier in front of the Django cache.
+    """
+    def __init__(self, max_size=1000, timeout=5):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        local_caches.add(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return default
+            if expires <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_caches = weakref.WeakSet()
+
+
+def clear_local_caches():
+    """ Empties every LocalCache in this process (e.g. between tests) """
+    for local_cache in list(local_caches):
+        local_cache.clear()
+
+
+#---[ Generations ]------------------------------------------------------------
+
+# Cached method results can be keyed on a generation of their model instance,
+# which is replaced whenever the instance is saved or deleted, invalidating
+# them all at once (see cache_method's invalidate_on_save).
+
+def uses_generations(options):
+    """ Whether a cache_method's `options` call for generations """
+    if options['invalidate_on_save'] is not None:
+        return options['invalidate_on_save']
+    return getattr(settings, 'GENERIC_CACHE_METHOD_INVALIDATE_ON_SAVE', False)
+
+
+def new_generation():
+    # time-based, so that a generation evicted from the cache isn't reused
+    return '%x%03x' % (int(time.time() * 1000), random.getrandbits(12))
+
+
+def get_root_model(model):
+    """ Returns the base of `model`'s (multi-table) inheritance hierarchy """
+    model = model._meta.concrete_model
+    parents = model._meta.get_parent_list()
+    return parents[-1] if parents else model
+
+
+def get_generation_key(obj):
+    """ Shared by all classes in a multi-table inheritance hierarchy """
+    return get_safe_cache_key('generic-generation-%s-%s' % (
+        get_root_model(obj.__class__)._meta.label_lower, obj.pk))
+
+
+def get_generation(obj, cache_name=None):
+    """
+    Returns the current generation of model instance `obj` as recorded in
+    cache `cache_name` (default: default), memoised on the instance.
+    """
+    alias = cache_name or 'default'
+    generations = obj.__dict__.setdefault('_cache_generations', {})
+    if alias not in generations:
+        generations[alias] = fetch_generations([obj], alias)[0]
+    return generations[alias]
+
+
+def fetch_generations(objects, cache_name=None):
+    """
+    Returns the generations of model instances `objects`, starting any that
+    are missing, with one get_many (and if need be, one add per missing).
+    """
+    cache_obj = caches[cache_name or 'default']
+    keys = [get_generation_key(obj) for obj in objects]
+    try:
+        found = cache_obj.get_many(keys)
+    except Exception as e:
+        logger.warning('Cache error: {0}'.format(e))
+        found = {}
+    for key in set(keys).difference(found):
+        generation = new_generation()
+        try:
+            if not cache_obj.add(key, generation, None):
+                generation = cache_obj.get(key) or generation
+        except Exception as e:
+            logger.warning('Cache error: {0}'.format(e))
+        found[key] = generation
+    return [found[key] for key in keys]
+
+
+_generation_cache_names = {}
+
+def get_generation_cache_names(model):
+    """
+    Returns names of the caches in which cached methods of any class in
+    `model`'s inheritance hierarchy (parents, children, proxies) record
+    generations, since they share them; see get_generation_key().
+    """
+    root = get_root_model(model)
+    try:
+        options = _generation_cache_names[root]
+    except KeyError:
+        options = _generation_cache_names[root] = [
+            value.cache_method_options
+            for other in apps.get_models()
+            if get_root_model(other) is root
+            for klass in other.__mro__
+            for value in list(vars(klass).values())
+            if hasattr(value, 'cache_method_options')
+        ]
+    return set(
+        options['cache_name'] or 'default' for options in options
+        if uses_generations(options)
+    )
+
+
+def bump_generation(sender, instance, **kwargs):
+    """ Invalidates the cached method results of `instance` """
+    instance.__dict__.pop('_cache_method_results', None) # prefetched
+    cache_names = get_generation_cache_names(sender)
+    if not cache_names:
+        return
+    key = get_generation_key(instance)
+    for cache_name in cache_names:
+        try:
+            caches[cache_name].set(key, new_generation(), None)
+        except Exception as e:
+            logger.warning('Cache error: {0}'.format(e))
+    instance.__dict__.pop('_cache_generations', None)
+
+post_save.connect(bump_generation, dispatch_uid='generic-bump-generation')
+post_delete.connect(bump_generation, dispatch_uid='generic-bump-generation')
+
+
+def forget_generation_cache_names(sender, **kwargs):
+    """ A new model may join an existing hierarchy """
+    _generation_cache_names.clear()
+
+class_prepared.connect(
+    forget_generation_cache_names,
+    dispatch_uid='generic-forget-generation-cache-names')
+
+
+#---[ Statistics ]-------------------------------------------------------------
+
+# cache_method keeps in-process counters per decorated method, which each
+# process flushes to the cache now and then (see flush_cache_method_stats()),
+# so that the `cache_method_stats` management command can report on them all.
+# Disable with settings.GENERIC_CACHE_METHOD_STATS = False.
+
+STATS_COUNTERS = ('hits', 'local_hits', 'prefetched_hits', 'misses', 'errors')
+
+# upper bounds, in seconds, of the compute time histogram's buckets
+STATS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float('inf'))
+
+STATS_INDEX_KEY = 'generic-cache-method-stats'
+
+
+def stats_enabled():
+    return getattr(settings, 'GENERIC_CACHE_METHOD_STATS', True)
+
+
+def get_payload_sample_rate():
+    """
+    Fraction of misses whose results are pickled to measure their size
+    (pickling them again isn't free); default 0, i.e. not measured
+    """
+    return getattr(settings, 'GENERIC_CACHE_METHOD_STATS_PAYLOAD', 0)
+
+
+class CacheMethodStats(object):
+    """
+    Thread-safe counters for one cached method: hits (from any tier, with
+    those from the local and prefetched tiers also counted separately),
+    misses, cache errors, a histogram of compute times and the pickled size
+    of a sample of computed results (see get_payload_sample_rate).
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+        cache_method_stats[name] = self
+
+    def reset(self):
+        with self._lock:
+            self.counts = dict.fromkeys(STATS_COUNTERS, 0)
+            self.compute_times = [0] * len(STATS_BUCKETS)
+            self.compute_total = 0.0
+            self.payload_samples = 0
+            self.payload_total = 0
+            self.payload_max = 0
+
+    def count(self, counter, tier=None):
+        """ Counts a hit (from `tier`, if not the cache), miss or error """
+        if not stats_enabled():
+            return
+        with self._lock:
+            self.counts[counter] += 1
+            if tier:
+                self.counts['%s_%s' % (tier, counter)] += 1
+        maybe_flush_cache_method_stats()
+
+    def record_compute(self, seconds, value):
+        """
+        Records a miss's compute time and, if sampled, the size of its result
+        """
+        if not stats_enabled():
+            return
+        size = None
+        rate = get_payload_sample_rate()
+        if rate and (rate >= 1 or random.random() < rate):
+            try:
+                size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            except Exception: # unpicklable; the cache will complain
+                pass
+        bucket = bisect.bisect_left(STATS_BUCKETS, seconds)
+        with self._lock:
+            self.compute_times[bucket] += 1
+            self.compute_total += seconds
+            if size is not None:
+                self.payload_samples += 1
+                self.payload_total += size
+                self.payload_max = max(self.payload_max, size)
+
+    def snapshot(self):
+        """ Returns the counters as a dict (see merge_cache_method_stats) """
+        with self._lock:
+            snapshot = dict(self.counts)
+            snapshot.update({
+                'compute_times': list(self.compute_times),
+                'compute_total': self.compute_total,
+                'payload_samples': self.payload_samples,
+                'payload_total': self.payload_total,
+                'payload_max': self.payload_max,
+            })
+        return snapshot
+
+
+cache_method_stats = {}
+
+
+def get_cache_method_stats():
+    """ Returns {method name: snapshot} of this process's counters """
+    return dict(
+        (name, stats.snapshot())
+        for name, stats in cache_method_stats.items()
+    )
+
+
+def reset_cache_method_stats():
+    for stats in list(cache_method_stats.values()):
+        stats.reset()
+
+
+def merge_cache_method_stats(snapshots):
+    """ Returns {method name: snapshot} summed over `snapshots` """
+    merged = {}
+    for snapshot in snapshots:
+        for name, stats in snapshot.items():
+            if name not in merged:
+                merged[name] = dict(stats, compute_times=list(
+                    stats['compute_times']))
+                continue
+            total = merged[name]
+            for key, value in stats.items():
+                if key == 'compute_times':
+                    total[key] = [a + b for a, b in zip(total[key], value)]
+                elif key == 'payload_max':
+                    total[key] = max(total[key], value)
+                else:
+                    total[key] = total.get(key, 0) + value
+    return merged
+
+
+def summarise_cache_method_stats(stats):
+    """
+    Returns a snapshot's hit ratio, mean and (approximate, i.e. the bucket
+    bound) 95th percentile compute time and mean (sampled) payload size.
+    """
+    calls = stats['hits'] + stats['misses']
+    percentile = None
+    if stats['misses']:
+        seen = 0
+        for bound, number in zip(STATS_BUCKETS, stats['compute_times']):
+            seen += number
+            if seen >= stats['misses'] * 0.95:
+                percentile = bound
+                break
+    return {
+        'calls': calls,
+        'hit_ratio': stats['hits'] / calls if calls else None,
+        'compute_mean': (
+            stats['compute_total'] / stats['misses'] if stats['misses']
+            else None),
+        'compute_p95': percentile,
+        'payload_mean': (
+            stats['payload_total'] / stats['payload_samples']
+            if stats.get('payload_samples') else None),
+    }
+
+
+def get_stats_cache():
+    return caches[
+        getattr(settings, 'GENERIC_CACHE_METHOD_STATS_CACHE', 'default')]
+
+
+def get_process_stats_key():
+    return get_safe_cache_key('%s-%s-%s' % (
+        STATS_INDEX_KEY, socket.gethostname(), os.getpid()))
+
+
+def get_stats_flush_interval():
+    """ Seconds between automatic flushes, or None for none """
+    return getattr(
+        settings, 'GENERIC_CACHE_METHOD_STATS_FLUSH_INTERVAL', 60)
+
+
+_next_stats_flush = [None]
+
+def maybe_flush_cache_method_stats():
+    """ Flushes if a flush interval has passed since the last (or start) """
+    interval = get_stats_flush_interval()
+    if interval is None:
+        return
+    now = time.time()
+    if _next_stats_flush[0] is None:
+        _next_stats_flush[0] = now + interval
+    elif now >= _next_stats_flush[0]:
+        _next_stats_flush[0] = now + interval
+        flush_cache_method_stats()
+
+
+def flush_cache_method_stats():
+    """
+    Stores this process's counters in the cache, listed in an index so that
+    collect_cache_method_stats() can find them. Entries of processes which
+    stop flushing expire after ten flush intervals (or a day).
+    """
+    cache_obj = get_stats_cache()
+    key = get_process_stats_key()
+    timeout = (get_stats_flush_interval() or 8640) * 10
+    try:
+        cache_obj.set(key, get_cache_method_stats(), timeout)
+        # racy, but any key lost is re-added by its process's next flush
+        index = cache_obj.get(STATS_INDEX_KEY) or []
+        if key not in index:
+            cache_obj.set(STATS_INDEX_KEY, index + [key], None)
+    except Exception as e:
+        logger.warning('Cache error: {0}'.format(e))
+
+
+def collect_cache_method_stats():
+    """
+    Returns {process key: snapshots} as last flushed by each process, pruning
+    expired processes from the index.
+    """
+    cache_obj = get_stats_cache()
+    index = cache_obj.get(STATS_INDEX_KEY) or []
+    found = cache_obj.get_many(index)
+    if len(found) < len(index):
+        cache_obj.set(
+            STATS_INDEX_KEY, [key for key in index if key in found], None)
+    return found
@@ -1,13 +1,165 @@
-from operator import add
-from functools import reduce
+from collections import defaultdict
+
+from django.utils.encoding import force_text
+from django.utils.functional import lazy
+
+
+def _title_if_lower(s):
+    s = force_text(s)
+    return s.title() if s == s.lower() else s
+title_if_lower = lazy(_title_if_lower, str)
+
+
+class InheritanceRegistry(object):
+    """
+    Maps models to their subclasses, concrete descendants, parent links and
+    subclass choices, so that lookups don't have to scan every installed
+    model (or walk __subclasses__) on each call.
+
+    Built when the app registry is ready (see generic.apps.GenericConfig);
+    call clear() if models are created dynamically after that.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.is_built = False
+        self._descendants = {}
+        self._parent_links = {}
+        self._subclass_choices = {}
+        self._subclass_models = {}
+        self._subclasses = {}
+
+    def build(self):
+        from django.apps import apps
+        self.clear()
+        descendants = defaultdict(list)
+        subclass_choices = defaultdict(list)
+        subclass_models = defaultdict(dict)
+        for model in apps.get_models():
+            self._parent_links[model] = dict(model._meta.parents)
+            for parent in model._meta.parents:
+                subclass_models[parent][model._meta.model_name] = model
+                subclass_choices[parent].append((
+                    model._meta.model_name,
+                    title_if_lower(model._meta.verbose_name),
+                ))
+            if not model._meta.proxy:
+                for ancestor in model._meta.get_parent_list():
+                    descendants[ancestor].append(model)
+        self._descendants = dict(
+            (model, tuple(sorted(
+                models, key=lambda m: len(m._meta.get_parent_list()))))
+            for model, models in descendants.items()
+        )
+        self._subclass_choices = dict(
+            (model, tuple(sorted(choices, key=lambda choice: choice[0])))
+            for model, choices in subclass_choices.items()
+        )
+        self._subclass_models = dict(subclass_models)
+        self.is_built = True
+
+    def _ensure_built(self):
+        if not self.is_built:
+            self.build()
+
+    def get_descendants(self, model):
+        """
+        Returns concrete, installed models inheriting (via multi-table
+        inheritance) from `model`, shallowest first.
+        """
+        self._ensure_built()
+        return self._descendants.get(model, ())
+
+    def get_parent_links(self, model):
+        """ Returns a {parent model: parent link field} mapping """
+        self._ensure_built()
+        return self._parent_links.get(model, {})
+
+    def get_subclass_choices(self, parent_model):
+        """
+        Returns sorted (model_name, verbose name) choices for installed models
+        directly inheriting from `parent_model`.
+        """
+        self._ensure_built()
+        return list(self._subclass_choices.get(parent_model, ()))
+
+    def get_subclass(self, parent_model, model_name):
+        """
+        Returns the model directly inheriting from `parent_model` named
+        `model_name` (as per get_subclass_choices), or None.
+        """
+        self._ensure_built()
+        return self._subclass_models.get(parent_model, {}).get(model_name)
+
+    def get_subclasses(self, model, include_abstract=False):
+        key = (model, include_abstract)
+        try:
+            return self._subclasses[key]
+        except KeyError:
+            pass
+        subclasses = set()
+        pending = [model]
+        while pending:
+            klass = pending.pop()
+            if klass in subclasses:
+                continue
+            subclasses.add(klass)
+            pending.extend(klass.__subclasses__())
+        result = self._subclasses[key] = tuple(
+            klass for klass in subclasses if hasattr(klass, '_meta') and (
+                include_abstract or not klass._meta.abstract)
+        )
+        return result
+
+
+registry = InheritanceRegistry()
 
-def _get_subclasses(klass):
-    return (klass,) + reduce(add, list(map(_get_subclasses, klass.__subclasses__())), ())
 
 def get_subclasses(model, include_abstract=False):
     """
     Returns a list of unique models that inherit from the specified model. If
     include_abstract is True, abstract inheriting models will also be returned.
     """
-    return list(set([klass for klass in _get_subclasses(model) \
-        if hasattr(klass, '_meta') and (include_abstract or not klass._meta.abstract)]))
\ No newline at end of file
+    return list(registry.get_subclasses(model, include_abstract))
+
+
+def with_results(queryset, objects):
+    """
+    Returns a copy of `queryset` which evaluates as `objects` (e.g. the same
+    rows as subclass instances) without querying again, but remains a
+    queryset, as e.g. an admin changelist's list_editable formset requires.
+    """
+    queryset = queryset._chain()
+    queryset._result_cache = list(objects)
+    queryset._prefetch_done = True
+    return queryset
+
+
+def backfill_leaf_field(model, field_name, get_value, empty=None,
+                        overwrite=False):
+    """
+    Sets `field_name` on the rows of `model` (a multi-table inheritance base)
+    to get_value(leaf_model), where leaf_model is the most specific concrete
+    class of each row, using one UPDATE per descendant model.
+
+    Only rows where the field is `empty` are updated unless `overwrite` is
+    True. Returns a list of (model, number of rows updated) pairs.
+    """
+    models = (model,) + registry.get_descendants(model)
+    if overwrite:
+        # shallowest first, so that deeper classes have the last word
+        queryset = model._base_manager.all()
+    else:
+        # deepest first, so that rows are claimed by their leaf class
+        models = models[::-1]
+        queryset = model._base_manager.filter(**{field_name: empty})
+    updated = []
+    for leaf_model in models:
+        rows = queryset
+        if leaf_model is not model:
+            rows = rows.filter(pk__in=leaf_model._base_manager.values('pk'))
+        updated.append(
+            (leaf_model, rows.update(**{field_name: get_value(leaf_model)})))
+    return updated
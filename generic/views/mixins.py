@@ -4,15 +4,19 @@ import django.views.generic
 
 from django import http
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import PermissionDenied
+from django.core import serializers
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 try:
     from django.shortcuts import resolve_url
 except ImportError:
     from generic.utils.future import resolve_url
+from django.utils.dateparse import parse_datetime
 from django.utils.http import urlquote
 from django.utils.decorators import method_decorator
 
 from .exceptions import RedirectInstead
+from ..mixins import changed_since, get_changed_since_cursor
 from ..utils.tokens import get_token
 
 class Authenticated(django.views.generic.View):
@@ -337,3 +341,81 @@ class HashedURLView(django.views.generic.View):
         if provided_hash != expected_hash:
             return http.HttpResponseForbidden('Invalid hash')
         return super(HashedURLView, self).dispatch(request, *args, **kwargs)
+
+
+class ChangedSinceView(django.views.generic.View):
+    """
+    JSON feed of HousekeepingMixin objects changed since a cursor, for
+    incremental sync; e.g.
+
+        url(r'^sync/articles/$', ChangedSinceView.as_view(model=Article))
+
+    Responds with {"objects": [...], "cursor": "...", "more": true/false};
+    pass the cursor back as ?since=... to get the next batch. Deleted objects
+    are included as {"pk": ..., "deleted": true} tombstones.
+
+    No access control is applied; combine with e.g. Authenticated.
+    """
+    model = None
+    queryset = None
+    fields = None # serialized fields; default all
+    paginate_by = 100
+    cursor_parameter = 'since'
+
+    def get_queryset(self):
+        if self.queryset is not None:
+            return self.queryset.all()
+        # not _default_manager, which might well hide deleted objects
+        return self.model._base_manager.all()
+
+    def parse_cursor(self, value):
+        date_modified, pk = value.split(',', 1)
+        date_modified = parse_datetime(date_modified)
+        if date_modified is None:
+            raise ValueError('Invalid date')
+        return (date_modified, self.get_queryset().model._meta.pk.to_python(pk))
+
+    def format_cursor(self, cursor):
+        date_modified, pk = cursor
+        return '%s,%s' % (date_modified.isoformat(), pk)
+
+    def is_tombstone(self, obj):
+        # HousekeepingMixin's flag, or Delible's date
+        return bool(getattr(obj, 'deleted', False))
+
+    def serialize(self, objects):
+        live = [obj for obj in objects if not self.is_tombstone(obj)]
+        serialized = dict(
+            (obj.pk, data) for obj, data in zip(live, serializers.serialize(
+                'python', live, fields=self.fields))
+        )
+        return [
+            serialized.get(obj.pk) or {'pk': obj.pk, 'deleted': True}
+            for obj in objects
+        ]
+
+    def get(self, request, *args, **kwargs):
+        cursor = request.GET.get(self.cursor_parameter)
+        if cursor:
+            try:
+                cursor = self.parse_cursor(cursor)
+            except (ValueError, ValidationError):
+                return http.HttpResponseBadRequest('Invalid cursor')
+        objects = list(
+            changed_since(self.get_queryset(), cursor or None)[
+                :self.paginate_by + 1])
+        more = len(objects) > self.paginate_by
+        objects = objects[:self.paginate_by]
+        if objects:
+            cursor = get_changed_since_cursor(objects[-1])
+        return http.HttpResponse(
+            json.dumps(
+                {
+                    'objects': self.serialize(objects),
+                    'cursor': self.format_cursor(cursor) if cursor else None,
+                    'more': more,
+                },
+                cls=DjangoJSONEncoder,
+            ),
+            content_type='application/json',
+        )